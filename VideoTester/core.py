@@ -7,10 +7,12 @@
 import os, ConfigParser, signal, pickle, time, socket
 from SimpleXMLRPCServer import SimpleXMLRPCServer
 from xmlrpclib import ServerProxy
-from multiprocessing import Process
+from multiprocessing import Process, cpu_count
 from . import VTLOG, netifaces, supported_codecs, supported_protocols
 from .gstreamer import RTSPServer, RTSPClient
 from .sniffer import Sniffer
+from .utils import ProcessingPool
+from .measures.core import ResultCache
 from .measures.qos import QoSmeter
 from .measures.bs import BSmeter
 from .measures.vq import VQmeter
@@ -191,6 +193,31 @@ class VTClient(VTBase):
         #: Parsed configuration.
         self.conf = dict(self.parseConf(self.CONF, 'client'))
         self.conf['temp'] = os.path.abspath(self.conf['temp'])
+        self.conf['prefetch'] = int(self.conf.get('prefetch', 0))
+        self.conf['align'] = self.conf.get('align', 'no').lower() in ('1', 'yes', 'true', 'on')
+        self.conf['step'] = int(self.conf.get('step', 1))
+        if self.conf['step'] < 1:
+            raise Exception('Option step must be positive')
+        self.conf['ssim_downsample'] = self.conf.get('ssim_downsample', 'no').lower() in ('1', 'yes', 'true', 'on')
+        self.conf['miv_interval'] = int(self.conf.get('miv_interval', 25))
+        self.conf['freeze_threshold'] = float(self.conf.get('freeze_threshold', 0))
+        self.conf['sample'] = self.conf.get('sample', 'no').lower()
+        if self.conf['sample'] not in ('no', 'random', 'gop'):
+            raise Exception('Sampling mode %s not supported' % self.conf['sample'])
+        self.conf['sample_width'] = float(self.conf.get('sample_width', 0.02))
+        self.conf['sample_confidence'] = float(self.conf.get('sample_confidence', 0.95))
+        self.conf['backend'] = self.conf.get('backend', 'auto').lower()
+        if self.conf['backend'] not in ('auto', 'serial', 'threads', 'processes'):
+            raise Exception('Backend %s not supported' % self.conf['backend'])
+        for key, n in [('frames', 2), ('roi', 4)]:
+            if self.conf.get(key):
+                self.conf[key] = tuple(int(x) for x in self.conf[key].split(','))
+                if len(self.conf[key]) != n:
+                    raise Exception('Option %s needs %s comma separated values' % (key, n))
+            else:
+                self.conf[key] = None
+        if self.conf['roi'] and (min(self.conf['roi'][:2]) < 0 or min(self.conf['roi'][2:]) < 1):
+            raise Exception('Option roi needs a non-negative position and a positive size')
         self.conf['bitrate'] = int(self.conf['bitrate'])
         self.conf['framerate'] = int(self.conf['framerate'])
         if self.conf['codec'] not in supported_codecs.keys():
@@ -199,6 +226,16 @@ class VTClient(VTBase):
             raise Exception('Protocol %s not supported' % self.conf['protocol'])
         if self.conf['iface'] not in netifaces:
             raise Exception('Interface %s not found' % self.conf['iface'])
+        #: Worker processes for the video quality measures, shared by all the runs
+        #: (started on first use, see :meth:`close`).
+        self.pool = ProcessingPool(cpu_count(), start=False) if cpu_count() > 1 else None
+
+    def close(self):
+        '''
+        Stop the worker processes.
+        '''
+        if self.pool is not None:
+            self.pool.shutdown()
 
     def __get_tempdir(self):
         tempdir = '%s/%s_%s_%s_%s_%s/' % (self.conf['temp'], self.conf['video'], self.conf['codec'], self.conf['bitrate'], self.conf['framerate'], self.conf['protocol'])
@@ -276,12 +313,29 @@ class VTClient(VTBase):
         if ret:
             return None
 
+        roi = self.conf['roi']
+        caps = rtspclient.caps
+        if roi and (roi[0] + roi[2] > caps['width'] or roi[1] + roi[3] > caps['height']):
+            VTLOG.error('ROI %s does not fit in %sx%s frames' % (roi, caps['width'], caps['height']))
+            return None
+
         video = '/'.join([self.path, dict(self.videos)[self.conf['video']]])
         rtspclient.makeReference(video)
         conf = {
             'codec': self.conf['codec'],
             'bitrate': self.conf['bitrate'],
             'framerate': self.conf['framerate'],
+            'align': self.conf['align'],
+            'step': self.conf['step'],
+            'frames': self.conf['frames'],
+            'roi': self.conf['roi'],
+            'miv_interval': self.conf['miv_interval'],
+            'freeze_threshold': self.conf['freeze_threshold'],
+            'ssim_downsample': self.conf['ssim_downsample'],
+            'sample': None if self.conf['sample'] == 'no' else self.conf['sample'],
+            'sample_width': self.conf['sample_width'],
+            'sample_confidence': self.conf['sample_confidence'],
+            'backend': None if self.conf['backend'] == 'auto' else self.conf['backend'],
             'caps': rtspclient.caps
         }
         packetdata = sniffer.parsePkts(self.conf['protocol'], rtspclient.caps)
@@ -289,9 +343,10 @@ class VTClient(VTBase):
             rtspclient.files, rtspclient.caps, self.conf['codec'])
 
         results = []
-        results.extend(QoSmeter(self.conf['qos'], packetdata).run())
-        results.extend(BSmeter(self.conf['bs'], codecdata).run())
-        results.extend(VQmeter(self.conf['vq'], (conf, rawdata, codecdata, packetdata)).run())
+        cache = ResultCache()
+        results.extend(QoSmeter(self.conf['qos'], packetdata, cache).run())
+        results.extend(BSmeter(self.conf['bs'], codecdata, cache).run())
+        results.extend(VQmeter(self.conf['vq'], (conf, rawdata, codecdata, packetdata), cache, self.pool).run())
 
         VTLOG.info('Saving measures...')
         for measure in results:
@@ -308,8 +363,10 @@ class VTClient(VTBase):
         rawdata = {}
         for x in videofiles.keys():
             if x != 'original':
-                codecdata[x] = CodedVideo(videofiles[x][0], codec)
+                # A single read window is large enough to keep the parser busy
+                codecdata[x] = CodedVideo(videofiles[x][0], codec,
+                    prefetch=min(self.conf['prefetch'], 1))
             rawdata[x] = YUVVideo(videofiles[x][1], (
                 caps['width'], caps['height'], caps['format']
-            ))
+            ), prefetch=self.conf['prefetch'])
         return codecdata, rawdata
@@ -12,6 +12,7 @@ from gi.repository import Gst, GstVideo, GObject
 from . import __version__, VTLOG, VTClient, netifaces, \
     supported_codecs, supported_protocols
 from .resources import getVTIcon, getVTBitmap
+from .measures import Meter, heatmap
 
 class FuncLog(logging.Handler):
     '''
@@ -91,10 +92,16 @@ class VTframe(wx.Frame):
 
         self.vq = []
         self.vq.append(('psnr', wx.CheckBox(self.conf_tab, -1, 'PSNR')))
+        self.vq.append(('psnru', wx.CheckBox(self.conf_tab, -1, 'PSNR-U')))
+        self.vq.append(('psnrv', wx.CheckBox(self.conf_tab, -1, 'PSNR-V')))
+        self.vq.append(('psnryuv', wx.CheckBox(self.conf_tab, -1, 'PSNR-YUV')))
+        self.vq.append(('psnrmap', wx.CheckBox(self.conf_tab, -1, 'PSNR-MB')))
         self.vq.append(('ssim', wx.CheckBox(self.conf_tab, -1, 'SSIM')))
+        self.vq.append(('msssim', wx.CheckBox(self.conf_tab, -1, 'MS-SSIM')))
         self.vq.append(('g1070', wx.CheckBox(self.conf_tab, -1, 'G.1070')))
         self.vq.append(('psnrtomos', wx.CheckBox(self.conf_tab, -1, 'PSNRtoMOS')))
         self.vq.append(('miv', wx.CheckBox(self.conf_tab, -1, 'MIV')))
+        self.vq.append(('freeze', wx.CheckBox(self.conf_tab, -1, 'Freeze')))
         self.sb_vq = wx.StaticBox(self.conf_tab, -1, 'Video quality measures:')
 
         self.log_tab = wx.Panel(self.tabs, -1)
@@ -157,8 +164,11 @@ class VTframe(wx.Frame):
 
         self.protocol.SetSelection(supported_protocols.index(self.main.conf['protocol']))
 
+        selected = []
+        for kind in ['qos', 'bs', 'vq']:
+            selected.extend(Meter.parse(self.main.conf[kind]))
         for name, el in self.qos + self.bs + self.vq:
-            if name in self.main.conf['qos'] + self.main.conf['bs'] + self.main.conf['vq']:
+            if name in selected:
                 el.SetValue(True)
 
         self.results_tab.Hide()
@@ -307,6 +317,7 @@ class VTframe(wx.Frame):
                 self.pipeline.set_state(Gst.State.NULL)
             except:
                 pass
+            self.main.close()
             VTLOG.removeHandler(self.hdlr)
             self.Destroy() # frame
 
@@ -481,6 +492,13 @@ class VTframe(wx.Frame):
                 axes.bar(measure['axes'][0], measure['axes'][1]['I'], width=1, color='r')
                 axes.set_xlabel(measure['units'][0])
                 axes.set_ylabel(measure['units'][1])
+            elif measure['type'] == 'heatmap':
+                x, values = measure['axes'][0], heatmap(measure)
+                image = axes.imshow(values, aspect='auto', interpolation='nearest',
+                    extent=(x[0], x[-1] + 1, len(values), 0) if x else None)
+                axes.figure.colorbar(image, ax=axes).set_label(measure['units'][2])
+                axes.set_xlabel(measure['units'][0])
+                axes.set_ylabel(measure['units'][1])
         self.results_tab.Show()
 
 class Plot(wx.Panel):
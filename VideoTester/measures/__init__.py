@@ -5,22 +5,24 @@
 ## This program is published under a GPLv3 license
 
 __all__ = [
-    'Meter', 'Measure',
+    'Meter', 'Measure', 'ResultCache', 'heatmap',
     'QoSmeter', 'QoSmeasure',
     'Latency', 'Delta', 'Jitter', 'Skew', 'Bandwidth',
     'PacketLossRate', 'PacketLossDist',
     'BSmeter', 'BSmeasure',
     'StreamEye', 'RefStreamEye', 'GOP', 'IFrameLossRate',
     'VQmeter', 'VQmeasure',
-    'PSNR', 'SSIM', 'G1070', 'PSNRtoMOS', 'MIV'
+    'PSNR', 'PSNRU', 'PSNRV', 'PSNRYUV', 'PSNRMap',
+    'SSIM', 'MSSSIM', 'G1070', 'PSNRtoMOS', 'MIV', 'Freeze'
 ]
-from .core import Meter, Measure
+from .core import Meter, Measure, ResultCache, heatmap
 from .qos import QoSmeter, QoSmeasure, \
     Latency, Delta, Jitter, Skew, Bandwidth, \
     PacketLossRate, PacketLossDist
 from .bs import BSmeter, BSmeasure, \
     StreamEye, RefStreamEye, GOP, IFrameLossRate
 from .vq import VQmeter, VQmeasure, \
-    PSNR, SSIM, G1070, PSNRtoMOS, MIV
+    PSNR, PSNRU, PSNRV, PSNRYUV, PSNRMap, \
+    SSIM, MSSSIM, G1070, PSNRtoMOS, MIV, Freeze
 
 del(core, qos, bs, vq)
@@ -6,22 +6,26 @@
 
 import numpy as np
 from .. import VTLOG
+from ..video import frametypes
 from .core import Meter, Measure
 
 class BSmeter(Meter):
     '''
     Bit-stream meter.
     '''
-    def __init__(self, selected, data):
+    def __init__(self, selected, data, cache=None):
         '''
         **On init:** Register selected bit-stream measures.
 
         :param selected: Selected bit-stream measures.
         :type selected: string or list
         :param tuple data: Collected bit-stream parameters.
+        :param cache: Results shared with other meters of the same run.
+        :type cache: ResultCache
         '''
-        Meter.__init__(self)
+        Meter.__init__(self, cache)
         VTLOG.info('Starting BSmeter...')
+        selected = self.parse(selected)
         if 'streameye' in selected:
             self.measures.append(StreamEye(data))
         if 'refstreameye' in selected:
@@ -46,6 +50,25 @@ class BSmeasure(Measure):
         self.coded = codecdata['received']
         #: Frame information from coded video.
         self.codedref = codecdata['coded']
+        self.input = (self.coded, self.codedref)
+
+    def getGOPs(self):
+        '''
+        Get the sizes of the *Groups Of Pictures* in the received video.
+
+        :returns: GOP sizes and number of I frames.
+        :rtype: tuple
+        '''
+        types = self.coded.table['type']
+        types = types[types != 0xff]
+        iframes = np.flatnonzero(types == frametypes.index('I'))
+        if len(iframes) == 0:
+            return np.array([len(types)], dtype=float), 0
+        gops = np.diff(iframes)
+        if iframes[0] != 0:
+            gops = np.r_[iframes[0] + 1, gops]
+        gops = np.r_[gops, len(types) - 1 - iframes[-1]]
+        return gops.astype(float), len(iframes)
 
 class StreamEye(BSmeasure):
     '''
@@ -66,19 +89,11 @@ class StreamEye(BSmeasure):
         self.data['name'] = video + self.data['name']
 
     def calculate(self):
-        x = range(len(self.v.frames['lengths']))
-        Iframes = [0 for i in x]
-        Pframes = [0 for i in x]
-        Bframes = [0 for i in x]
-        for i in x:
-            type = self.v.frames['types'][i]
-            if type == 'I':
-                Iframes[i] = self.v.frames['lengths'][i]
-            elif type == 'P':
-                Pframes[i] = self.v.frames['lengths'][i]
-            elif type == 'B':
-                Bframes[i] = self.v.frames['lengths'][i]
-        y = {'I':Iframes, 'P':Pframes, 'B':Bframes}
+        table = self.v.table[self.v.table['length'] > 0]
+        x = range(len(table))
+        y = {}
+        for type in ['I', 'P', 'B']:
+            y[type] = np.where(table['type'] == frametypes.index(type), table['length'], 0).tolist()
         self.data['axes'] = [x, y]
         return self.data
 
@@ -106,23 +121,10 @@ class GOP(BSmeasure):
         self.data['units'] = 'GOP size'
 
     def calculate(self):
-        gops = []
-        gop = 0
-        for i in range(len(self.coded.frames['types'])):
-            gop += 1
-            if self.coded.frames['types'][i] == 'I':
-                if i != 0:
-                    gops.append(gop)
-                gop = 0
-        gops.append(gop)
-        gops = np.array(gops, dtype=float)
-        loss = []
+        gops = self.getGOPs()[0]
         lim1 = np.mean(gops) - np.std(gops)/2
         lim2 = np.mean(gops) + np.std(gops)/2
-        for i in range(len(gops)):
-            if (gops[i] < lim1) or (gops[i] > lim2):
-                loss.append(i)
-        gops = np.delete(gops, loss)
+        gops = gops[(gops >= lim1) & (gops <= lim2)]
         self.data['value'] = int(round(np.mean(gops)))
         return self.data
 
@@ -140,23 +142,9 @@ class IFrameLossRate(BSmeasure):
         self.data['units'] = 'rate'
 
     def calculate(self):
-        count = 0
-        gops = []
-        gop = 0
-        for i in range(len(self.coded.frames['types'])):
-            gop += 1
-            if self.coded.frames['types'][i] == 'I':
-                count += 1
-                if i != 0:
-                    gops.append(gop)
-                gop = 0
-        gops.append(gop)
-        gops = np.array(gops, dtype=float)
-        loss = []
+        gops, count = self.getGOPs()
         lim = np.mean(gops) + np.std(gops)
-        for i in range(len(gops)):
-            if gops[i] > lim:
-                loss.append(i)
-        rate = float(len(loss)) / float(count + len(loss))
+        loss = np.count_nonzero(gops > lim)
+        rate = float(loss) / float(count + loss)
         self.data['value'] = rate
         return self.data
@@ -4,19 +4,103 @@
 ## Copyright 2011-2016 Iñaki Úcar <iucar@fedoraproject.org>
 ## This program is published under a GPLv3 license
 
+import numpy as np
 from .. import VTLOG
 
+def heatmap(measure):
+    '''
+    Aggregate a `heatmap` measure over time: each block row is averaged across the frame.
+
+    :param dict measure: Results of a `heatmap` measure (see :attr:`Measure.data`).
+
+    :returns: A ``(rows, frames)`` array of values, in the units of the measure.
+    :rtype: numpy.ndarray
+    '''
+    maps = measure['axes'][1]
+    if not maps.size:
+        return np.zeros((0, len(maps)))
+    return maps.mean(axis=2).T * measure['step']
+
+class ResultCache:
+    '''
+    Per-run store of measure results, keyed by measure name and input identity,
+    so that every measure is computed at most once per run and reused by
+    anything that depends on it. The dependencies declared by a measure
+    (see :attr:`Measure.depends`) are computed before it.
+    '''
+    def __init__(self):
+        #: Dictionary of ``(input objects, results)`` by measure key (see :meth:`key`).
+        self.results = {}
+        self.__running = []
+
+    def key(self, measure):
+        '''
+        :returns: The name of the measure and the identity of its input objects.
+        :rtype: tuple
+        '''
+        return measure.data['name'], tuple(id(x) for x in measure.input)
+
+    def get(self, measure):
+        '''
+        Get the results of a measure, computing it (and its dependencies) if needed.
+
+        :param measure: The measure.
+        :type measure: Measure
+
+        :returns: Results (see :attr:`Measure.data`).
+        :rtype: dict
+        '''
+        key = self.key(measure)
+        if key in self.results:
+            VTLOG.debug('Reusing %s' % measure.data['name'])
+            return self.results[key][1]
+        if key in self.__running:
+            raise Exception('Circular dependency on %s' % measure.data['name'])
+        self.__running.append(key)
+        try:
+            measure.cache = self
+            for kind, name in measure.depends:
+                measure.getDependency(kind, name)
+            # Input objects are kept alive so that their ids are not reused
+            self.results[key] = measure.input, measure.calculate()
+        finally:
+            self.__running.remove(key)
+        return self.results[key][1]
+
 class Meter:
     '''
     Generic meter.
     '''
-    def __init__(self):
+    def __init__(self, cache=None):
+        '''
+        :param cache: Results shared with other meters of the same run.
+        :type cache: ResultCache
+        '''
         #: List of measures.
         self.measures = []
+        #: Per-run result cache (see :class:`ResultCache`).
+        self.cache = cache if cache is not None else ResultCache()
+
+    @staticmethod
+    def parse(selected):
+        '''
+        Parse a selection of measures, so that names are matched exactly
+        (e.g., `psnr` does not select `psnrtomos`).
+
+        :param selected: Comma separated measure names or list of names.
+        :type selected: string or list
+
+        :returns: The list of names, stripped and in lower case.
+        :rtype: list
+        '''
+        if isinstance(selected, basestring):
+            selected = selected.split(',')
+        return [name.strip().lower() for name in selected]
 
     def run(self):
         '''
-        Run registered measures. For each measure in :attr:`measures`, this method calls :meth:`Measure.calculate`.
+        Run registered measures. For each measure in :attr:`measures`, this method calls
+        :meth:`Measure.calculate`, unless it was already computed in this run (see :attr:`cache`).
 
         :returns: The list of measures.
         :rtype: list
@@ -25,7 +109,7 @@ class Meter:
         for measure in self.measures:
             VTLOG.info('- Measuring: ' + measure.data['name'])
             try:
-                measures.append(measure.calculate())
+                measures.append(self.cache.get(measure))
             except Exception, e:
                 VTLOG.error(e)
         return measures
@@ -41,15 +125,24 @@ class Measure:
 
         * `name`: The name.
         * `units`: The units (e.g.: ``'ms'``, ``['time (s)', 'kbps']``, etc.).
-        * `type`: The type: `plot`, `bar`, `value` or `videoframes`.
+        * `type`: The type: `plot`, `bar`, `value`, `videoframes` or `heatmap`.
             * If ``type = 'plot'``: `axes`, `max`, `min`, `mean`.
             * If ``type = 'bar'``: `axes`, `max`, `min`, `mean`, `width`.
             * If ``type = 'value'``: `value`.
             * If ``type = 'videoframes'``: `axes`.
+            * If ``type = 'heatmap'``: `axes` (frame numbers and a ``(frames, rows, columns)``
+              ``uint8`` array of quantized values), `block` (block side) and `step`
+              (quantization step). See :func:`heatmap`.
         '''
         self.data['name'] = None
         self.data['type'] = None
         self.data['units'] = None
+        #: Input objects, whose identity tells apart results of measures with the same name.
+        self.input = ()
+        #: Measures needed by this one, as ``(meter, name)`` pairs (e.g.: ``('qos', 'plr')``).
+        self.depends = []
+        #: Per-run result cache (see :class:`ResultCache`), set when run by a meter.
+        self.cache = None
 
     def calculate(self):
         '''
@@ -63,6 +156,21 @@ class Measure:
         '''
         pass
 
+    def getDependency(self, kind, name):
+        '''
+        Get the results of a measure this one depends on (see :attr:`depends`).
+
+        :param string kind: Meter (e.g.: ``'qos'``).
+        :param string name: Measure, as selected in the configuration (e.g.: ``'plr'``).
+
+        :returns: Results (see :attr:`data`).
+        :rtype: dict
+
+        .. note::
+            This method MUST be overwritten by the subclasses with dependencies.
+        '''
+        raise Exception('%s cannot resolve %s:%s' % (self.data['name'], kind, name))
+
     def __max(self, x, y):
         '''
         Find the maximum value.
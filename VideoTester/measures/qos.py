@@ -4,24 +4,27 @@
 ## Copyright 2011-2016 Iñaki Úcar <iucar@fedoraproject.org>
 ## This program is published under a GPLv3 license
 
+import numpy as np
 from .. import VTLOG
-from ..utils import multiSort
 from .core import Meter, Measure
 
 class QoSmeter(Meter):
     '''
     QoS meter.
     '''
-    def __init__(self, selected, data):
+    def __init__(self, selected, data, cache=None):
         '''
         **On init:** Register selected QoS measures.
 
         :param selected: Selected QoS measures.
         :type selected: string or list
         :param tuple data: Collected QoS parameters.
+        :param cache: Results shared with other meters of the same run.
+        :type cache: ResultCache
         '''
-        Meter.__init__(self)
+        Meter.__init__(self, cache)
         VTLOG.info('Starting QoSmeter...')
+        selected = self.parse(selected)
         if 'latency' in selected:
             self.measures.append(Latency(data))
         if 'delta' in selected:
@@ -62,6 +65,7 @@ class QoSmeasure(Measure):
         self.timestamps = timestamps
         #: Round-trip time information (see :attr:`VideoTester.sniffer.Sniffer.rtt`).
         self.rtt = rtt
+        self.input = (lengths, times, sequences, timestamps, rtt)
 
 class Latency(QoSmeasure):
     '''
@@ -96,9 +100,7 @@ class Delta(QoSmeasure):
 
     def calculate(self):
         x = self.sequences
-        y = [0 for i in range(0, len(self.times))]
-        for i in range(1, len(self.times)):
-            y[i] = (self.times[i] - self.times[i-1]) * 1000
+        y = [0] + (np.diff(self.times) * 1000).tolist()
         self.graph(x, y)
         return self.data
 
@@ -117,10 +119,13 @@ class Jitter(QoSmeasure):
 
     def calculate(self):
         x = self.sequences
-        y = [0 for i in range(0, len(self.times))]
-        for i in range(1, len(self.times)):
-            d = ((self.times[i] - self.timestamps[i]) - (self.times[i-1] - self.timestamps[i-1])) * 1000
-            y[i] = y[i-1] + (abs(d) - y[i-1]) / 16
+        d = np.abs(np.diff(np.subtract(self.times, self.timestamps)) * 1000)
+        # The recursion is run as is: a linear filter would not round the same way
+        y = [0]
+        j = 0
+        for dj in d.tolist():
+            j = j + (dj - j) / 16
+            y.append(j)
         self.graph(x, y)
         return self.data
 
@@ -139,9 +144,7 @@ class Skew(QoSmeasure):
 
     def calculate(self):
         x = self.sequences
-        y = [0 for i in range(0, len(self.times))]
-        for i in range(1, len(self.times)):
-            y[i] = (self.timestamps[i] - self.times[i]) * 1000
+        y = [0] + ((np.asarray(self.timestamps[1:]) - self.times[1:]) * 1000).tolist()
         self.graph(x, y)
         return self.data
 
@@ -159,28 +162,23 @@ class Bandwidth(QoSmeasure):
         self.data['units'] = ('time (s)', 'kbps')
 
     def calculate(self):
-        self.times, self.lengths = multiSort(self.times, self.lengths)
-        x = self.times
-        y = [0 for i in range(0, len(x))]
-        for i in range(1, len(x)):
-            if x[i] == x[i-1]:
-                y[i] = -1
-        supr = True
-        while supr:
-            try:
-                x.pop(y.index(-1))
-                y.pop(y.index(-1))
-                self.lengths.pop(y.index(-1))
-            except:
-                supr = False
-        for i in range(1, len(x)):
-            length = 0
-            j = i
-            while x[j] + 1 > x[i] and j >= 0:
-                length = length + self.lengths[j] * 8 / 1000
-                j = j - 1
-            y[i] = length
-        self.graph(x, y)
+        times, lengths = np.asarray(self.times), np.asarray(self.lengths)
+        # Sort by time, and by length among equal times
+        order = np.argsort(times, kind='mergesort')
+        x = times[order]
+        repeated = np.flatnonzero(x[1:] == x[:-1]) + 1
+        tied = np.union1d(repeated - 1, repeated)
+        order[tied] = order[tied[np.lexsort((lengths[order[tied]], x[tied]))]]
+        lengths = lengths[order]
+        # Packets received at the same time as the previous one are dropped. The
+        # lengths dropped along are those before each repeated time but the first.
+        x = np.delete(x, repeated)
+        lengths = np.delete(lengths, repeated[1:] - 1)
+        # kbits received from the first packet less than 1 s older
+        kbits = np.concatenate(([0], np.cumsum(lengths[:len(x)] * 8 / 1000)))
+        first = np.searchsorted(x + 1, x, side='right')
+        y = [0] + (kbits[2:] - kbits[first[1:]]).tolist()
+        self.graph(x.tolist(), y)
         return self.data
 
 class PacketLossRate(QoSmeasure):
@@ -197,9 +195,8 @@ class PacketLossRate(QoSmeasure):
         self.data['units'] = 'rate'
 
     def calculate(self):
-        loss = 0
-        for i in range(1, len(self.sequences)):
-            loss = loss + self.sequences[i] - self.sequences[i-1] - 1
+        # Gaps between consecutive sequence numbers add up to the whole span
+        loss = self.sequences[-1] - self.sequences[0] - (len(self.sequences) - 1)
         rate = float(loss) / float(self.sequences[-1] + 1)
         self.data['value'] = rate
         return self.data
@@ -219,22 +216,18 @@ class PacketLossDist(QoSmeasure):
         self.data['width'] = 1 #seconds
 
     def calculate(self):
-        edge = self.data['width']
-        x = []
-        y = []
-        i = 1
-        j = 1
-        count = 1
-        while i < len(self.times):
-            x.append((j-1) * self.data['width'])
-            loss = 0
-            while i < len(self.times) and self.times[i] < edge:
-                count = count + 1
-                loss = loss + self.sequences[i] - self.sequences[i-1] - 1
-                i = i + 1
-            y.append(float(loss) / count)
-            count = 0
-            edge = edge + self.data['width']
-            j = j + 1
+        width = self.data['width']
+        times = np.asarray(self.times[1:])
+        # Each packet (but the first) falls in the first interval that ends after it
+        # arrives, or in the one of the previous packet if it arrives out of order
+        edges = np.cumsum([width] * (int(times.max() / width) + 2))
+        bins = np.maximum.accumulate(np.searchsorted(edges, times, side='right'))
+        n = bins[-1] + 1
+        loss = np.bincount(bins, np.diff(self.sequences) - 1, n)
+        count = np.bincount(bins, minlength=n)
+        count[0] += 1
+        x = [i * width for i in xrange(n)]
+        # Intervals without packets have no losses
+        y = (loss / np.maximum(count, 1)).tolist()
         self.graph(x, y)
         return self.data
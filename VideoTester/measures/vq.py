@@ -4,11 +4,14 @@
 ## Copyright 2011-2016 Iñaki Úcar <iucar@fedoraproject.org>
 ## This program is published under a GPLv3 license
 
-import math, cv2
-from itertools import izip
+import math, time, threading, bisect, cv2
+import numpy as np
+from itertools import izip, izip_longest
 from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from .. import VTLOG
-from ..utils import ProcessingPool
+from ..utils import ProcessingPool, SharedArray
+from ..video import frametypes
 from .core import Meter, Measure
 from .qos import QoSmeter
 from .bs import BSmeter
@@ -17,26 +20,49 @@ class VQmeter(Meter):
     '''
     Video quality meter.
     '''
-    def __init__(self, selected, data):
+    def __init__(self, selected, data, cache=None, pool=None):
         '''
         **On init:** Register selected video quality measures.
 
         :param selected: Selected video quality measures.
         :type selected: string or list
         :param tuple data: Collected QoS + bit-stream + video parameters.
+        :param cache: Results shared with other meters of the same run.
+        :type cache: ResultCache
+        :param pool: Worker processes for the per-frame computations (see :class:`VQengine`).
+        :type pool: VideoTester.utils.ProcessingPool
         '''
-        Meter.__init__(self)
+        Meter.__init__(self, cache)
         VTLOG.info('Starting VQmeter...')
+        selected = self.parse(selected)
         if 'psnr' in selected:
             self.measures.append(PSNR(data))
+        if 'psnru' in selected:
+            self.measures.append(PSNRU(data))
+        if 'psnrv' in selected:
+            self.measures.append(PSNRV(data))
+        if 'psnryuv' in selected:
+            self.measures.append(PSNRYUV(data))
+        if 'psnrmap' in selected:
+            self.measures.append(PSNRMap(data))
         if 'ssim' in selected:
             self.measures.append(SSIM(data))
+        if 'msssim' in selected:
+            self.measures.append(MSSSIM(data))
         if 'g1070' in selected:
             self.measures.append(G1070(data))
         if 'psnrtomos' in selected:
             self.measures.append(PSNRtoMOS(data))
         if 'miv' in selected:
             self.measures.append(MIV(data))
+        if 'freeze' in selected:
+            self.measures.append(Freeze(data))
+        # Compute the series needed by all the measures in a single pass
+        engine = VQengine(data[0], data[1], pool=pool, codecdata=data[2])
+        for measure in self.measures:
+            measure.engine = engine
+            for key in measure.series:
+                engine.require(*key)
 
 class VQmeasure(Measure):
     '''
@@ -46,13 +72,15 @@ class VQmeasure(Measure):
         '''
         **On init:** Register QoS + bit-stream + video parameters.
 
-        :param string conf: Video parameters: `codec`, `bitrate`, `framerate` and `size`.
+        :param string conf: Video parameters: `codec`, `bitrate`, `framerate`, `size`, and
+            evaluation options: `align`, `step`, `frames`, `roi` and `backend` (see :class:`VQengine`),
+            and those of each measure.
         :param dict rawdata: Frame information from YUV videos (`original`, `received` and `coded`).
         :param dict codecdata: Frame information from compressed videos (`received` and `coded`).
         :param tuple packetdata: QoS parameters.
         '''
         Measure.__init__(self)
-        #: Video parameters: `codec`, `bitrate`, `framerate` and `size`.
+        #: Video parameters and evaluation options.
         self.conf = conf
         self.rawdata = rawdata
         #: Frame information from received YUV.
@@ -63,6 +91,46 @@ class VQmeasure(Measure):
         self.codecdata = codecdata
         #: QoS parameters.
         self.packetdata = packetdata
+        #: Per-frame series needed, as ``(metric, video, reference)`` (see :meth:`VQengine.require`).
+        self.series = []
+        #: Engine that computes the series (see :class:`VQengine`).
+        self.engine = None
+        #: Sampling mode, if the mean of the series is estimated (see :meth:`graphSeries`).
+        self.sample = (conf or {}).get('sample')
+        self.input = (conf, rawdata['received'], rawdata['original'])
+
+    def getSeries(self, metric, video='received', ref='original'):
+        '''
+        Get a per-frame series from :attr:`engine` (a private one is created if
+        the measure does not belong to a :class:`VQmeter`).
+
+        :returns: Frame numbers and values (see :meth:`VQengine.get`).
+        :rtype: tuple
+        '''
+        return self.__engine().get(metric, video, ref)
+
+    def graphSeries(self, metric, video='received', ref='original'):
+        '''
+        Graph a per-frame series (see :meth:`getSeries`). If the `sample` option is set,
+        the mean is estimated from a sample of frames instead (see :meth:`VQengine.estimate`):
+        the graph shows the sampled frames, `mean` is the estimate and `ci` its confidence
+        interval.
+        '''
+        if not self.sample:
+            x, y = self.getSeries(metric, video, ref)
+            self.graph(x, y)
+            return
+        x, y, mean, half = self.__engine().estimate(metric, video, ref)
+        self.graph(x, y)
+        self.data['mean'] = mean
+        self.data['ci'] = (mean - half, mean + half)
+
+    def __engine(self):
+        if self.engine is None:
+            self.engine = VQengine(self.conf, self.rawdata, codecdata=self.codecdata)
+            for key in self.series:
+                self.engine.require(*key)
+        return self.engine
 
     def getQoSm(self, measures):
         '''
@@ -75,7 +143,7 @@ class VQmeasure(Measure):
         :rtype: list
         '''
         VTLOG.info('----------getQoSm----------')
-        measures = QoSmeter(measures, self.packetdata).run()
+        measures = QoSmeter(measures, self.packetdata, self.cache).run()
         VTLOG.info('---------------------------')
         return measures
 
@@ -90,16 +158,479 @@ class VQmeasure(Measure):
         :rtype: list
         '''
         VTLOG.info('----------getBSm-----------')
-        measures = BSmeter(measures, self.codecdata).run()
+        measures = BSmeter(measures, self.codecdata, self.cache).run()
         VTLOG.info('---------------------------')
         return measures
 
-def doPSNR(frame1, frame2):
-    sum = (frame1.astype(int) - frame2.astype(int))**2
-    mse = sum.sum() / frame1.size
-    if mse != 0:
-        return 20 * math.log(255 / math.sqrt(mse), 10)
-    else: return 100
+    def getDependency(self, kind, name):
+        if kind == 'qos':
+            return self.getQoSm([name])[0]
+        elif kind == 'bs':
+            return self.getBSm([name])[0]
+        return Measure.getDependency(self, kind, name)
+
+class VQengine:
+    '''
+    Fused computation of per-frame series (PSNR, SSIM...) for several measures.
+
+    The received, coded and original videos are read once, in lock-step and block
+    by block, and every required series is computed in that single pass. All the
+    series share the same timeline (see :meth:`select`). Blocks are computed serially,
+    spread over threads (numpy and cv2 release the GIL during the arithmetic) or over
+    a pool of worker processes that map the videos themselves (see :meth:`chooseBackend`).
+    '''
+    def __init__(self, conf, rawdata, n=16, backend=None, pool=None, codecdata=None):
+        '''
+        :param dict conf: Evaluation options: `align`, `step`, `frames`, `roi`, `backend`
+            and sampling options (see :meth:`estimate`).
+        :param dict rawdata: YUV videos (`original`, `received` and `coded`).
+        :param int n: Frames per block.
+        :param string backend: `serial`, `threads` or `processes` (see :meth:`chooseBackend`).
+            Defaults to the `backend` option in `conf`.
+        :param pool: Long-lived pool for the `processes` backend (it is not shut down
+            afterwards). A temporary one is used if not given.
+        :type pool: VideoTester.utils.ProcessingPool
+        :param dict codecdata: Compressed videos (`received` and `coded`), used to
+            stratify samples by position in the GOP.
+        '''
+        self.conf = conf or {}
+        self.rawdata = rawdata
+        self.codecdata = codecdata or {}
+        self.n = n
+        #: Worker processes shared with other engines, if any.
+        self.pool = pool
+        #: Forced backend, if any.
+        self.backend = backend or self.conf.get('backend')
+        if self.backend not in (None, 'serial', 'threads', 'processes'):
+            raise Exception('Backend %s not supported' % self.backend)
+        #: Computed series, by ``(metric, video, reference)``.
+        self.results = {}
+        self.__pending = set()
+
+    def require(self, metric, video='received', ref='original'):
+        '''
+        Announce that a series will be needed, so that it is computed in the next pass.
+
+        :param string metric: Metric name (see :data:`metrics`).
+        :param string video: Video (`received` or `coded`).
+        :param string ref: Reference video (`original` or `coded`).
+        '''
+        if (metric, video, ref) not in self.results:
+            self.__pending.add((metric, video, ref))
+
+    def get(self, metric, video='received', ref='original'):
+        '''
+        Get a series, running a pass for all the pending ones if it is not computed yet.
+
+        :returns: Frame numbers (of the received video) and values. Series involving
+            the coded video stop where it ends.
+        :rtype: tuple
+        '''
+        self.require(metric, video, ref)
+        if self.__pending:
+            self.run()
+        return self.results[(metric, video, ref)]
+
+    def select(self):
+        '''
+        Select the frames to be compared.
+
+        Received frames are paired with original frames by position unless `align` is
+        set in :attr:`conf`. In that case, each received frame is paired with the
+        original frame that it matches best (see :meth:`VideoTester.video.YUVVideo.align`),
+        which accounts for lost and repeated frames. Coded frames correspond one to
+        one to original frames. Then, if `frames` is set to ``(a, b)``, only received
+        frames in ``[a, b)`` are kept and, if `step` is set to `N`, only one in `N`.
+
+        :returns: The received frame numbers and the matching original frame numbers.
+        :rtype: tuple
+        '''
+        yuv, yuvref = self.rawdata['received'], self.rawdata['original']
+        if self.conf.get('align'):
+            x = range(yuv.frames)
+            index = yuv.align(yuvref).tolist()
+        else:
+            x = index = range(min(yuv.frames, yuvref.frames))
+        first, last = self.conf.get('frames') or (None, None)
+        step = self.conf.get('step', 1)
+        return x[first:last:step], index[first:last:step]
+
+    def run(self):
+        '''
+        Compute all the pending series in a single pass. Frames left out by
+        :meth:`select` are never read. If `roi` is set in :attr:`conf`, frames
+        are restricted to that region (see :meth:`VideoTester.video.YUVVideo.crop`).
+        '''
+        start = time.time()
+        pending = sorted(self.__pending)
+        self.__pending = set()
+        x, index = self.select()
+        series, backend = self.__compute(pending, x, index)
+        for key, y in izip(pending, series):
+            self.results[key] = (x[:len(y)], y)
+        elapsed = time.time() - start
+        VTLOG.info('VQ engine: %s on %i frames in %.2f s (%.1f fps, %s)' % (
+            ', '.join('%s (%s/%s)' % key for key in pending),
+            len(x), elapsed, len(x) / elapsed if elapsed else 0, backend))
+
+    def estimate(self, metric, video='received', ref='original'):
+        '''
+        Estimate the mean of a series from a sample of the frames given by :meth:`select`.
+
+        Frames are drawn without replacement, in batches, from a single stratum if
+        `sample` is `random` in :attr:`conf`, or from strata of frames at similar
+        positions in the GOP if it is `gop` (see :meth:`strata`). After each batch,
+        the stratified mean and its confidence interval (at the `sample_confidence`
+        level, 0.95 by default) are updated, and sampling stops once the interval is
+        narrower than `sample_width` times the mean (0.02 by default, so that the
+        same option fits PSNR and SSIM). The sample is reproducible.
+        If the whole series is computed anyway, its exact mean is given.
+
+        :returns: The sampled frame numbers and values (in frame order), the mean
+            and the half-width of its confidence interval.
+        :rtype: tuple
+        '''
+        key = (metric, video, ref)
+        if key in self.__pending:
+            self.run()
+        if key in self.results:
+            x, y = self.results[key]
+            return x, y, float(np.mean(y)) if y else 0., 0.
+        start = time.time()
+        x, index = self.select()
+        # Frames that exist in both videos
+        valid = np.ones(len(x), dtype=bool)
+        for name in (video, ref):
+            frames = np.asarray(x if name == 'received' else index, dtype=int)
+            valid &= frames < self.rawdata[name].frames
+        strata = [s[valid[s]] for s in self.strata(x)]
+        strata = [s for s in strata if len(s)]
+        rng = np.random.RandomState(0)
+        queues = [list(rng.permutation(s)) for s in strata]
+        values = [[] for _ in strata]
+        sizes = [len(s) for s in strata]
+        width = self.conf.get('sample_width', 0.02)
+        z = normalQuantile(0.5 + self.conf.get('sample_confidence', 0.95) / 2)
+        batch = 4 * self.n
+        mean, half = 0., 0.
+        while any(queues):
+            chosen = []
+            for h, queue in enumerate(queues):
+                k = max(int(math.ceil(batch * sizes[h] / float(sum(sizes)))), 2 - len(values[h]))
+                chosen.extend((p, h) for p in queue[:k])
+                del queue[:k]
+            chosen.sort()
+            y = self.__compute([key], [x[p] for p, _ in chosen], [index[p] for p, _ in chosen])[0][0]
+            for (p, h), v in izip(chosen, y):
+                values[h].append((p, v))
+            mean, half = stratifiedMean([[v for _, v in vals] for vals in values], sizes)
+            half *= z
+            if 2 * half <= width * abs(mean):
+                break
+        sample = sorted(item for vals in values for item in vals)
+        VTLOG.info('VQ engine: %s (%s/%s) estimated on %i of %i frames in %.2f s: %.4f +- %.4f' % (
+            metric, video, ref, len(sample), sum(sizes), time.time() - start, mean, half))
+        return [x[p] for p, _ in sample], [v for _, v in sample], mean, half
+
+    def strata(self, x):
+        '''
+        Split frames into strata for sampling (see :meth:`estimate`). With `sample = gop`
+        in :attr:`conf` and the frame table of the received compressed video, I frames
+        make up a stratum and the rest of the frames are split into 4 strata by their
+        distance to the previous I frame. Frames before the first I frame and frames
+        not in the table make up another stratum each. Otherwise, there is a single stratum.
+
+        :param list x: Received frame numbers.
+
+        :returns: An array of positions in `x` for each stratum.
+        :rtype: list
+        '''
+        coded = self.codecdata.get('received')
+        x = np.asarray(x, dtype=int)
+        if self.conf.get('sample') != 'gop' or coded is None or not len(coded.table):
+            return [np.arange(len(x))]
+        types = coded.table['type']
+        frames = np.arange(len(types))
+        last = np.maximum.accumulate(np.where(types == frametypes.index('I'), frames, -1))
+        position = frames - last
+        after = last >= 0
+        top = max(position[after].max(), 1) if after.any() else 1
+        stratum = np.where(position == 0, 0, 1 + (position - 1) * 4 // top)
+        stratum = np.where(after, stratum, 5)
+        stratum = np.where(x < len(types), stratum[np.minimum(x, len(types) - 1)], 6)
+        return [np.flatnonzero(stratum == k) for k in np.unique(stratum)]
+
+    def __compute(self, pending, x, index):
+        '''
+        Compute some series on the given frames.
+
+        :returns: The list of series and the backend used.
+        :rtype: tuple
+        '''
+        names = sorted(set(name for _, video, ref in pending for name in (video, ref)))
+        videos, keys, counts = {}, {}, {}
+        for name in names:
+            video = self.rawdata[name]
+            if self.conf.get('roi'):
+                video = video.crop(self.conf['roi'])
+            frames = x if name == 'received' else index
+            frames = frames[:bisect.bisect_left(frames, video.frames)]
+            videos[name] = video
+            counts[name] = len(frames)
+            keys[name] = [stackKey(frames[i:i+self.n]) for i in xrange(0, len(frames), self.n)]
+        original = self.rawdata['original']
+        peak = original.peak
+
+        backend = self.chooseBackend()
+        if backend == 'processes':
+            series = self.__share(pending, videos, keys, counts, peak)
+        else:
+            series = self.__iterate(pending, videos, keys, peak, backend == 'threads')
+        return series, backend
+
+    def chooseBackend(self):
+        '''
+        Choose how blocks are computed: :attr:`backend`, if set, or else
+
+        * `serial` if there is a single core,
+        * `threads` if blocks have at least 2^20 pixels: the arithmetic dominates
+          and releases the GIL, and threads share the frames without any copy,
+        * `processes` if there is a :attr:`pool`: with smaller frames, the Python
+          overhead per block is significant and holds the GIL,
+        * `serial` otherwise (starting processes would not pay off).
+
+        :returns: `serial`, `threads` or `processes`.
+        :rtype: string
+        '''
+        if self.backend:
+            return self.backend
+        roi = self.conf.get('roi')
+        original = self.rawdata['original']
+        width, height = roi[2:] if roi else (original.width, original.height)
+        if cpu_count() < 2:
+            return 'serial'
+        if self.n * width * height >= 2**20:
+            return 'threads'
+        if self.pool is not None:
+            return 'processes'
+        return 'serial'
+
+    def __iterate(self, pending, videos, keys, peak, threads=False):
+        '''
+        Compute the series in this process, reading the blocks in lock-step,
+        optionally spreading them over threads.
+        '''
+        names = sorted(videos)
+        readers = [videos[name].read(keys[name]) for name in names]
+        compute = lambda blocks: blockSeries(pending, dict(izip(names, blocks)), peak)
+        if threads:
+            pool = ThreadPool(cpu_count())
+            blocks = pool.imap(compute, izip_longest(*readers))
+        else:
+            pool = None
+            blocks = (compute(b) for b in izip_longest(*readers))
+        series = [[] for _ in pending]
+        for values in blocks:
+            for y, v in izip(series, values):
+                y.extend(v)
+        if pool is not None:
+            pool.close()
+        return series
+
+    def __share(self, pending, videos, keys, counts, peak):
+        '''
+        Compute the series in worker processes (:attr:`pool` or a temporary pool).
+        Only the videos (pickled by name) and the frame numbers of each block are
+        sent: every worker maps the files and writes its values into a
+        :class:`VideoTester.utils.SharedArray`. Blocks are sent in a few chunks
+        per worker, to amortize the cost of each task.
+        '''
+        blocks = max(len(k) for k in keys.itervalues())
+        outs = []
+        for metric, video, ref in pending:
+            dtype, shape = shapes.get(metric, (np.float64, None))
+            shape = shape(videos[video].width, videos[video].height) if shape else ()
+            outs.append(SharedArray((blocks * self.n,) + shape, dtype))
+        done = SharedArray((blocks,), np.bool_)
+        pool = self.pool or ProcessingPool(cpu_count())
+        size = max(blocks / (4 * pool.N), 1)
+        try:
+            for first in xrange(0, blocks, size):
+                chunk = [(i, i * self.n, dict((name, k[i] if i < len(k) else None)
+                    for name, k in keys.iteritems()))
+                    for i in xrange(first, min(first + size, blocks))]
+                pool.add_task(sharedBlockSeries, pending, videos, chunk, peak, outs, done)
+            pool.drain()
+            if not done.array.all():
+                raise Exception('VQ engine: some blocks could not be computed')
+            series = []
+            for out, (_, video, ref) in izip(outs, pending):
+                y = out.array[:min(counts[video], counts[ref])]
+                series.append(y.tolist() if y.ndim == 1 else list(np.array(y)))
+        finally:
+            if pool is not self.pool:
+                pool.shutdown()
+            for out in outs + [done]:
+                out.close()
+        return series
+
+def blockSeries(pending, blocks, peak):
+    '''
+    Compute several series over a block of frames.
+
+    :param list pending: ``(metric, video, reference)`` keys (see :data:`metrics` and
+        :data:`derived`). Each metric is computed once, even if several keys depend on it,
+        and not at all if it comes along with another one (see :data:`companions`).
+    :param dict blocks: Frame stacks by video name (``None`` if the video has ended).
+        Stacks of different lengths are trimmed to the shortest one.
+    :param int peak: Peak sample value.
+
+    :returns: A list of values for each key.
+    :rtype: list
+    '''
+    computed = {}
+    def compute(metric, video, ref):
+        key = (metric, video, ref)
+        if key not in computed:
+            block, refblock = blocks[video], blocks[ref]
+            if block is None or refblock is None:
+                computed[key] = []
+            elif metric in derived:
+                inputs, func = derived[metric]
+                computed[key] = map(func, *[compute(m, video, ref) for m in inputs])
+            else:
+                m = min(len(block['Y']), len(refblock['Y']))
+                if m < max(len(block['Y']), len(refblock['Y'])):
+                    block = dict((k, v[:m]) for k, v in block.iteritems())
+                    refblock = dict((k, v[:m]) for k, v in refblock.iteritems())
+                values = metrics[metric](block, refblock, peak)
+                if metric in companions:
+                    computed.update(((other, video, ref), values[other]) for other in companions[metric])
+                    values = values[metric]
+                computed[key] = values
+        return computed[key]
+    for key in sorted(pending, key=lambda key: key[0] not in companions):
+        compute(*key)
+    return [computed[key] for key in pending]
+
+def sharedBlockSeries(pending, videos, chunk, peak, outs, done):
+    '''
+    Worker task: compute several series over some blocks of frames (see :func:`blockSeries`)
+    and store them in `outs`.
+
+    :param dict videos: Videos by name.
+    :param list chunk: ``(block, offset, keys)`` tuples, where `keys` are the frame numbers
+        of the block (``None`` if the video has ended) by video name. The values are
+        stored in ``out.array[offset:]``.
+    :param list outs: :class:`VideoTester.utils.SharedArray` objects, one per series.
+    :param done: Flags set for each block computed.
+    :type done: SharedArray
+    '''
+    for i, offset, keys in chunk:
+        blocks = dict((name, None if key is None else videos[name][key])
+            for name, key in keys.iteritems())
+        for out, values in izip(outs, blockSeries(pending, blocks, peak)):
+            if len(values):
+                out.array[offset:offset+len(values)] = values
+        done.array[i] = True
+
+def stratifiedMean(values, sizes):
+    '''
+    Stratified estimate of the mean of a population.
+
+    :param list values: Sampled values of each stratum (at least 2, unless it is fully sampled).
+    :param list sizes: Size of each stratum.
+
+    :returns: The mean and its standard error (with finite population correction).
+    :rtype: tuple
+    '''
+    total = float(sum(sizes))
+    mean, var = 0., 0.
+    for y, size in izip(values, sizes):
+        if not len(y):
+            continue
+        weight = size / total
+        mean += weight * np.mean(y)
+        if len(y) < size:
+            var += weight**2 * (1 - len(y) / float(size)) * np.var(y, ddof=1) / len(y)
+    return mean, math.sqrt(var)
+
+def normalQuantile(p):
+    '''
+    :returns: The `p` quantile of the standard normal distribution.
+    '''
+    low, high = -40., 40.
+    for _ in xrange(64):
+        z = (low + high) / 2
+        if 0.5 * math.erfc(-z / math.sqrt(2)) < p:
+            low = z
+        else:
+            high = z
+    return (low + high) / 2
+
+def stackKey(frames):
+    '''
+    :returns: A slice selecting the given frame numbers if they are evenly
+        spaced (so the stack is a view), or the list of frame numbers otherwise.
+    '''
+    if len(frames) > 1:
+        step = frames[1] - frames[0]
+        if step > 0 and frames[-1] - frames[0] == step * (len(frames) - 1) and \
+                all(b - a == step for a, b in izip(frames, frames[1:])):
+            return slice(frames[0], frames[-1] + 1, step)
+    return list(frames)
+
+def blockPSNR(block1, block2, peak=255):
+    '''
+    PSNR of each frame of two stacks of frames.
+
+    Squared differences are computed in float32 and summed in float64, which
+    is exact for 8 and 10-bit samples. As in :func:`doPSNR`, the mean squared
+    error is truncated to an integer.
+
+    :returns: A list of PSNR values (100 for identical frames).
+    '''
+    diff = block1.astype(np.float32)
+    diff -= block2
+    diff *= diff
+    sse = diff.reshape(len(diff), -1).sum(axis=1, dtype=np.float64).astype(np.int64)
+    psnr = []
+    for mse in (sse // diff[0].size).tolist():
+        if mse != 0:
+            psnr.append(20 * math.log(peak / math.sqrt(mse), 10))
+        else:
+            psnr.append(100)
+    return psnr
+
+def blockPSNRMap(block1, block2, peak=255, size=16, step=0.5):
+    '''
+    PSNR of each macroblock of each frame of two stacks of frames.
+
+    Frames are viewed as ``(rows, size, columns, size)`` arrays of macroblocks
+    (the right and bottom edges are left out if they do not fill a macroblock),
+    so the squared error of every macroblock is summed at once.
+
+    :param int size: Macroblock side.
+    :param float step: Quantization step (dB).
+
+    :returns: A list of ``(rows, columns)`` arrays of PSNR values quantized to `step`
+        (so ``value * step`` is the PSNR), saturated to 255. As in :func:`blockPSNR`,
+        identical macroblocks have a PSNR of 100 dB.
+    '''
+    m, height, width = block1.shape
+    rows, cols = height / size, width / size
+    diff = block1[:, :rows*size, :cols*size].astype(np.float32)
+    diff -= block2[:, :rows*size, :cols*size]
+    diff *= diff
+    sse = diff.reshape(m, rows, size, cols, size).sum(axis=(2, 4), dtype=np.float64)
+    psnr = np.empty_like(sse)
+    psnr.fill(100)
+    lossy = sse > 0
+    psnr[lossy] = 10 * np.log10(float(peak)**2 * size * size / sse[lossy])
+    return list(np.rint(psnr / step).clip(0, 255).astype(np.uint8))
+
+def doPSNR(frame1, frame2, peak=255):
+    return blockPSNR(frame1[np.newaxis], frame2[np.newaxis], peak)[0]
 
 class PSNR(VQmeasure):
     '''
@@ -108,127 +639,335 @@ class PSNR(VQmeasure):
     * Type: `plot`.
     * Units: `dB per frame`.
     '''
+    #: Measure name.
+    name = 'PSNR'
+    #: Per-frame metric (see :data:`metrics`).
+    metric = 'psnr'
+
     def __init__(self, data, yuv=False, yuvref=False):
         VQmeasure.__init__(self, data)
-        self.data['name'] = 'PSNR'
+        self.data['name'] = self.name
         self.data['type'] = 'plot'
         self.data['units'] = ('frame', 'dB')
-        if yuv:
-            self.yuv = self.rawdata['coded']
-        if yuvref:
-            self.yuvref = self.rawdata['coded']
+        self.video = 'coded' if yuv else 'received'
+        self.ref = 'coded' if yuvref else 'original'
+        if not self.sample:
+            self.series = [(self.metric, self.video, self.ref)]
+        self.input = (self.conf, self.rawdata[self.video], self.rawdata[self.ref])
 
     def calculate(self):
-        size = min(self.yuv.frames, self.yuvref.frames)
-        x = range(0, size)
-        p = ProcessingPool(cpu_count())
-        for deg, ref in izip(self.yuv, self.yuvref):
-            p.add_task(doPSNR, deg['Y'], ref['Y'])
-        p.join()
-        y = list(p.get_results())
-        self.graph(x, y)
+        self.graphSeries(self.metric, self.video, self.ref)
         return self.data
 
-def doSSIM(frame1, frame2):
-    '''
-    The equivalent of Zhou Wang's SSIM matlab code using OpenCV.
-    from http://www.cns.nyu.edu/~zwang/files/research/ssim/index.html
-    The measure is described in :
-    "Image quality assessment: From error measurement to structural similarity"
-    C++ code by Rabah Mehdi. http://mehdi.rabah.free.fr/SSIM
-
-    C++ to Python translation and adaptation by Iñaki Úcar
-    '''
-    def array2cv(a):
-        dtype2depth = {
-            'uint8':   cv.IPL_DEPTH_8U,
-            'int8':    cv.IPL_DEPTH_8S,
-            'uint16':  cv.IPL_DEPTH_16U,
-            'int16':   cv.IPL_DEPTH_16S,
-            'int32':   cv.IPL_DEPTH_32S,
-            'float32': cv.IPL_DEPTH_32F,
-            'float64': cv.IPL_DEPTH_64F,
-        }
-        try:
-            nChannels = a.shape[2]
-        except:
-            nChannels = 1
-        cv_im = cv.CreateImageHeader((a.shape[1],a.shape[0]), dtype2depth[str(a.dtype)], nChannels)
-        cv.SetData(cv_im, a.tostring(), a.dtype.itemsize*nChannels*a.shape[1])
-        return cv_im
-
-    C1 = 6.5025
-    C2 = 58.5225
-    img1_temp = array2cv(frame1)
-    img2_temp = array2cv(frame2)
-    nChan = img1_temp.nChannels
-    d = cv.IPL_DEPTH_32F
-    size = img1_temp.width, img1_temp.height
-    img1 = cv.CreateImage(size, d, nChan)
-    img2 = cv.CreateImage(size, d, nChan)
-    cv.Convert(img1_temp, img1)
-    cv.Convert(img2_temp, img2)
-    img1_sq = cv.CreateImage(size, d, nChan)
-    img2_sq = cv.CreateImage(size, d, nChan)
-    img1_img2 = cv.CreateImage(size, d, nChan)
-    cv.Pow(img1, img1_sq, 2)
-    cv.Pow(img2, img2_sq, 2)
-    cv.Mul(img1, img2, img1_img2, 1)
-    mu1 = cv.CreateImage(size, d, nChan)
-    mu2 = cv.CreateImage(size, d, nChan)
-    mu1_sq = cv.CreateImage(size, d, nChan)
-    mu2_sq = cv.CreateImage(size, d, nChan)
-    mu1_mu2 = cv.CreateImage(size, d, nChan)
-    sigma1_sq = cv.CreateImage(size, d, nChan)
-    sigma2_sq = cv.CreateImage(size, d, nChan)
-    sigma12 = cv.CreateImage(size, d, nChan)
-    temp1 = cv.CreateImage(size, d, nChan)
-    temp2 = cv.CreateImage(size, d, nChan)
-    temp3 = cv.CreateImage(size, d, nChan)
-    ssim_map = cv.CreateImage(size, d, nChan)
-    #/*************************** END INITS **********************************/
-    #// PRELIMINARY COMPUTING
-    cv.Smooth(img1, mu1, cv.CV_GAUSSIAN, 11, 11, 1.5)
-    cv.Smooth(img2, mu2, cv.CV_GAUSSIAN, 11, 11, 1.5)
-    cv.Pow(mu1, mu1_sq, 2)
-    cv.Pow(mu2, mu2_sq, 2)
-    cv.Mul(mu1, mu2, mu1_mu2, 1)
-    cv.Smooth(img1_sq, sigma1_sq, cv.CV_GAUSSIAN, 11, 11, 1.5)
-    cv.AddWeighted(sigma1_sq, 1, mu1_sq, -1, 0, sigma1_sq)
-    cv.Smooth(img2_sq, sigma2_sq, cv.CV_GAUSSIAN, 11, 11, 1.5)
-    cv.AddWeighted(sigma2_sq, 1, mu2_sq, -1, 0, sigma2_sq)
-    cv.Smooth(img1_img2, sigma12, cv.CV_GAUSSIAN, 11, 11, 1.5)
-    cv.AddWeighted(sigma12, 1, mu1_mu2, -1, 0, sigma12)
-    #//////////////////////////////////////////////////////////////////////////
-    #// FORMULA
-    #// (2*mu1_mu2 + C1)
-    cv.Scale(mu1_mu2, temp1, 2)
-    cv.AddS(temp1, C1, temp1)
-    #// (2*sigma12 + C2)
-    cv.Scale(sigma12, temp2, 2)
-    cv.AddS(temp2, C2, temp2)
-    #// ((2*mu1_mu2 + C1).*(2*sigma12 + C2))
-    cv.Mul(temp1, temp2, temp3, 1)
-    #// (mu1_sq + mu2_sq + C1)
-    cv.Add(mu1_sq, mu2_sq, temp1)
-    cv.AddS(temp1, C1, temp1)
-    #// (sigma1_sq + sigma2_sq + C2)
-    cv.Add(sigma1_sq, sigma2_sq, temp2)
-    cv.AddS(temp2, C2, temp2)
-    #// ((mu1_sq + mu2_sq + C1).*(sigma1_sq + sigma2_sq + C2))
-    cv.Mul(temp1, temp2, temp1, 1)
-    #// ((2*mu1_mu2 + C1).*(2*sigma12 + C2))./((mu1_sq + mu2_sq + C1).*(sigma1_sq + sigma2_sq + C2))
-    cv.Div(temp3, temp1, ssim_map, 1)
-    index_scalar = cv.Avg(ssim_map)
-    #// through observation, there is approximately
-    #// 1% error max with the original matlab program
-    return index_scalar[0]
+class PSNRU(PSNR):
+    '''
+    PSNR-U: Peak Signal to Noise Ratio (U component).
 
-class SSIM(VQmeasure):
+    * Type: `plot`.
+    * Units: `dB per frame`.
+    '''
+    name = 'PSNR-U'
+    metric = 'psnr-u'
+
+class PSNRV(PSNR):
     '''
-    SSIM: Structural Similarity index (Y component).
+    PSNR-V: Peak Signal to Noise Ratio (V component).
 
     * Type: `plot`.
+    * Units: `dB per frame`.
+    '''
+    name = 'PSNR-V'
+    metric = 'psnr-v'
+
+class PSNRYUV(PSNR):
+    '''
+    PSNR-YUV: weighted Peak Signal to Noise Ratio, ``(6 * PSNR-Y + PSNR-U + PSNR-V) / 8``.
+
+    * Type: `plot`.
+    * Units: `dB per frame`.
+    '''
+    name = 'PSNR-YUV'
+    metric = 'psnr-yuv'
+
+class PSNRMap(VQmeasure):
+    '''
+    PSNR map: Peak Signal to Noise Ratio of each 16x16 macroblock (Y component).
+
+    * Type: `heatmap`, quantized in 0.5 dB steps (see :func:`blockPSNRMap`).
+    * Units: `dB per macroblock and frame`.
+    '''
+    def __init__(self, data):
+        VQmeasure.__init__(self, data)
+        self.data['name'] = 'PSNR-MB'
+        self.data['type'] = 'heatmap'
+        self.data['units'] = ('frame', 'macroblock row', 'dB')
+        self.data['block'] = 16
+        self.data['step'] = 0.5
+        self.series = [('psnr-map', 'received', 'original')]
+
+    def calculate(self):
+        x, maps = self.getSeries('psnr-map')
+        self.data['axes'] = (x, np.array(maps, dtype=np.uint8))
+        return self.data
+
+class Freeze(VQmeasure):
+    '''
+    Freezes: runs of received frames that repeat the previous one (the receiver
+    replaces lost frames by repeated ones).
+
+    A frame repeats the previous one if the mean absolute difference is not greater
+    than the `freeze_threshold` option (0 by default). Frames are first compared with
+    the previous one on a grid of one pixel out of `step` x `step` (see
+    :meth:`VideoTester.video.YUVVideo.differences`): the grid holds at least a
+    ``1 / step**2`` share of the pixels and at most the whole absolute difference, so
+    only frames whose grid difference is not greater than ``threshold * step**2`` can
+    be repeated. Only those are compared at full resolution. Frames outside the
+    `frames` option are never compared.
+
+    * Type: `bar`: duration of each freeze at the frame where it starts
+      (`frozen` holds the total number of frozen frames).
+    * Units: `frames`.
+    '''
+    def __init__(self, data):
+        VQmeasure.__init__(self, data)
+        self.data['name'] = 'Freeze'
+        self.data['type'] = 'bar'
+        self.data['units'] = ('frame', 'frozen frames')
+        self.data['width'] = 1
+        #: Maximum mean absolute difference between repeated frames.
+        self.threshold = (self.conf or {}).get('freeze_threshold') or 0
+        self.input = (self.conf, self.yuv)
+
+    def calculate(self):
+        conf = self.conf or {}
+        video = self.yuv.crop(conf['roi']) if conf.get('roi') else self.yuv
+        step = 4
+        first, last = conf.get('frames') or (None, None)
+        candidates = np.flatnonzero(video.differences(step, (first, last)) <= self.threshold * step**2)
+        frozen = np.zeros(video.frames, dtype=bool)
+        Y = video.planes['Y']
+        for i in xrange(0, len(candidates), 16):
+            k = candidates[i:i+16]
+            diff = np.abs(Y[k].astype(np.int16) - Y[k - 1]).reshape(len(k), -1)
+            frozen[k] = diff.mean(axis=1) <= self.threshold
+        frames = np.arange(video.frames)[first:last]
+        frozen = np.concatenate(([0], frozen[first:last], [0])).astype(np.int8)
+        edges = np.diff(frozen)
+        starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+        x, y = frames[starts].tolist(), (ends - starts).tolist()
+        if x:
+            self.graph(x, y)
+        else:
+            self.data['axes'] = (x, y)
+            self.data['max'] = self.data['min'] = (None, 0)
+            self.data['mean'] = 0
+        self.data['frozen'] = sum(y)
+        return self.data
+
+class SSIMEngine:
+    '''
+    SSIM index computed as in Zhou Wang's reference implementation (``ssim_index.m``),
+    from http://www.cns.nyu.edu/~zwang/files/research/ssim/index.html, described in:
+    "Image quality assessment: From error measurement to structural similarity".
+
+    The 11x11 Gaussian window (standard deviation 1.5) is applied as two separable
+    11-tap filters in float32 and the SSIM map is averaged over the region where the
+    window fits in the frame (`valid` filtering). Work buffers are allocated once per
+    frame size (and thread). The result differs from the reference implementation
+    (float64) by less than 1e-4.
+
+    Frames can be downsampled first by averaging blocks of pixels, as recommended
+    by the reference implementation for large frames (see :func:`ssimScale`).
+    '''
+    def __init__(self, size=11, sigma=1.5, K=(0.01, 0.03)):
+        '''
+        :param int size: Window size.
+        :param float sigma: Standard deviation of the Gaussian window.
+        :param tuple K: SSIM constants.
+        '''
+        #: Gaussian filter taps.
+        self.kernel = cv2.getGaussianKernel(size, sigma).astype(np.float32)
+        self.K = K
+        self.__local = threading.local()
+
+    def __buffers(self, shape, n=8):
+        buffers = getattr(self.__local, 'buffers', {})
+        self.__local.buffers = buffers
+        buffers.setdefault(shape, [])
+        while len(buffers[shape]) < n:
+            buffers[shape].append(np.empty(shape, dtype=np.float32))
+        return buffers[shape]
+
+    def __call__(self, frame1, frame2, peak=255, downsample=1):
+        '''
+        :param int downsample: Downsampling factor: frames are reduced to the averages
+            of `downsample` x `downsample` blocks (incomplete blocks are dropped).
+
+        :returns: The SSIM index of two frames.
+        :rtype: float
+        '''
+        if downsample > 1:
+            h, w = frame1.shape[0] / downsample, frame1.shape[1] / downsample
+            buffers = self.__buffers((h, w))
+            for frame, a, b in izip((frame1, frame2), self.__buffers(frame1.shape, 2), buffers):
+                np.copyto(a, frame, casting='unsafe')
+                cv2.resize(a[:h * downsample, :w * downsample], (w, h), dst=b,
+                           interpolation=cv2.INTER_AREA)
+            return self.__index(buffers, peak)
+        buffers = self.__buffers(frame1.shape)
+        np.copyto(buffers[0], frame1, casting='unsafe')
+        np.copyto(buffers[1], frame2, casting='unsafe')
+        return self.__index(buffers, peak)
+
+    def multiscale(self, frame1, frame2, peak=255, weights=(0.0448, 0.2856, 0.3001, 0.2363, 0.1333)):
+        '''
+        MS-SSIM index as in "Multi-scale structural similarity for image quality
+        assessment" (Wang, Simoncelli and Bovik, 2003). Both frames are loaded once
+        into a pyramid of 2x2 averages (an odd last row or column is dropped), built
+        in the work buffers of each scale. The filtered moments of each scale give
+        its contrast-structure term, and those of the last scale also its luminance
+        term. Scales smaller than the window are filtered with reflected borders.
+
+        :param tuple weights: Exponents of the scales, from the finest one.
+
+        :returns: The SSIM index (first scale) and the MS-SSIM index of two frames.
+        :rtype: tuple
+        '''
+        buffers = self.__buffers(frame1.shape)
+        np.copyto(buffers[0], frame1, casting='unsafe')
+        np.copyto(buffers[1], frame2, casting='unsafe')
+        scales = []
+        for i in xrange(len(weights) - 1):
+            # Next scale, before the moments overwrite this one
+            x, y = buffers[:2]
+            h, w = x.shape[0] / 2 * 2, x.shape[1] / 2 * 2
+            following = self.__buffers((h / 2, w / 2))
+            for a, b in izip((x, y), following):
+                cv2.resize(a[:h, :w], (w / 2, h / 2), dst=b, interpolation=cv2.INTER_AREA)
+            scales.append(self.__index(buffers, peak, cs=True))
+            buffers = following
+        value = max(self.__index(buffers, peak), 0)**weights[-1]
+        for (index, cs), weight in izip(scales, weights):
+            value *= max(cs, 0)**weight
+        return scales[0][0], value
+
+    def __index(self, buffers, peak, cs=False):
+        # Mean SSIM map (and contrast-structure map) of the frames loaded in x and y
+        x, y, t, mu1, mu2, s11, s22, s12 = buffers
+        C1 = (self.K[0] * peak)**2
+        C2 = (self.K[1] * peak)**2
+        k = self.kernel
+        cv2.sepFilter2D(x, cv2.CV_32F, k, k, dst=mu1)
+        cv2.sepFilter2D(y, cv2.CV_32F, k, k, dst=mu2)
+        np.multiply(x, x, out=t)
+        cv2.sepFilter2D(t, cv2.CV_32F, k, k, dst=s11)
+        np.multiply(y, y, out=t)
+        cv2.sepFilter2D(t, cv2.CV_32F, k, k, dst=s22)
+        np.multiply(x, y, out=t)
+        cv2.sepFilter2D(t, cv2.CV_32F, k, k, dst=s12)
+        # Drop the borders, where the window does not fit
+        b = len(k) / 2
+        if min(x.shape) > 2 * b:
+            mu1, mu2, s11, s22, s12, x, y, t = [
+                a[b:-b, b:-b] for a in (mu1, mu2, s11, s22, s12, x, y, t)]
+        # sigma1^2 + sigma2^2 + C2 and 2 sigma12 + C2 (in s11 and s12)
+        s11 += s22
+        np.multiply(mu1, mu1, out=x)
+        np.multiply(mu2, mu2, out=y)
+        s11 -= x
+        s11 -= y
+        s11 += C2
+        # mu1^2 + mu2^2 + C1 (in x) and 2 mu1 mu2 + C1 (in mu1)
+        x += y
+        x += C1
+        mu1 *= mu2
+        s12 -= mu1
+        s12 *= 2
+        s12 += C2
+        mu1 *= 2
+        mu1 += C1
+        if cs:
+            # Contrast-structure map (in t)
+            np.divide(s12, s11, out=t)
+        # SSIM map
+        mu1 *= s12
+        x *= s11
+        mu1 /= x
+        index = float(mu1.mean(dtype=np.float64))
+        return (index, float(t.mean(dtype=np.float64))) if cs else index
+
+#: Default SSIM engine.
+ssim = SSIMEngine()
+
+def doSSIM(frame1, frame2, peak=255, downsample=1):
+    '''
+    SSIM index of two frames (see :class:`SSIMEngine`).
+    '''
+    return ssim(frame1, frame2, peak, downsample)
+
+def ssimScale(width, height):
+    '''
+    Downsampling factor of the fast SSIM mode (see :class:`SSIMEngine`), as chosen
+    by the reference implementation: one per 256 pixels of the smaller dimension.
+
+    :returns: ``max(1, round(min(width, height) / 256))``.
+    :rtype: int
+    '''
+    return max(1, int(round(min(width, height) / 256.)))
+
+def doMSSSIM(frame1, frame2, peak=255):
+    '''
+    MS-SSIM index of two frames (see :meth:`SSIMEngine.multiscale`).
+    '''
+    return ssim.multiscale(frame1, frame2, peak)[1]
+
+def msssimSeries(block, ref, peak):
+    '''
+    MS-SSIM of a block of frames (see :data:`metrics`), along with the SSIM of its first scale.
+
+    :returns: Lists of values by metric.
+    :rtype: dict
+    '''
+    values = [ssim.multiscale(a, b, peak) for a, b in izip(block['Y'], ref['Y'])]
+    return {'ssim': [v[0] for v in values], 'ms-ssim': [v[1] for v in values]}
+
+#: Per-frame metrics computed by :class:`VQengine`: functions of a block of frames,
+#: the matching block of reference frames and the peak value that return a list of values.
+metrics = {
+    'psnr': lambda block, ref, peak: blockPSNR(block['Y'], ref['Y'], peak),
+    'psnr-u': lambda block, ref, peak: blockPSNR(block['U'], ref['U'], peak),
+    'psnr-v': lambda block, ref, peak: blockPSNR(block['V'], ref['V'], peak),
+    'psnr-map': lambda block, ref, peak: blockPSNRMap(block['Y'], ref['Y'], peak),
+    'ssim': lambda block, ref, peak: [ssim(a, b, peak) for a, b in izip(block['Y'], ref['Y'])],
+    'ssim-fast': lambda block, ref, peak: [ssim(a, b, peak, ssimScale(a.shape[1], a.shape[0]))
+                                           for a, b in izip(block['Y'], ref['Y'])],
+    'ms-ssim': msssimSeries
+}
+
+#: Metrics in :data:`metrics` that yield other metrics of the same frames for free:
+#: their functions return a dict of lists of values by metric.
+companions = {
+    'ms-ssim': ['ssim']
+}
+
+#: Type and shape (a function of the frame width and height) of the values
+#: of the metrics in :data:`metrics` that are not scalars.
+shapes = {
+    'psnr-map': (np.uint8, lambda width, height: (height / 16, width / 16))
+}
+
+#: Per-frame metrics computed by :class:`VQengine` from other metrics of the same frames:
+#: the list of metrics and a function of one value of each.
+derived = {
+    'psnr-yuv': (['psnr', 'psnr-u', 'psnr-v'], lambda y, u, v: (6 * y + u + v) / 8.)
+}
+
+class SSIM(VQmeasure):
+    '''
+    SSIM: Structural Similarity index (Y component). If the `ssim_downsample`
+    option is set, frames are downsampled first (see :func:`ssimScale`).
+
+    * Type: `plot` (`downsample` holds the downsampling factor).
     * Units: `SSIM index per frame`.
     '''
     def __init__(self, data):
@@ -236,16 +975,38 @@ class SSIM(VQmeasure):
         self.data['name'] = 'SSIM'
         self.data['type'] = 'plot'
         self.data['units'] = ('frame', 'SSIM index')
+        self.data['downsample'] = 1
+        #: Engine metric: `ssim` or `ssim-fast`.
+        self.metric = 'ssim'
+        if (self.conf or {}).get('ssim_downsample'):
+            roi = self.conf.get('roi')
+            width, height = roi[2:] if roi else (self.yuvref.width, self.yuvref.height)
+            self.data['downsample'] = ssimScale(width, height)
+            self.metric = 'ssim-fast'
+        if not self.sample:
+            self.series = [(self.metric, 'received', 'original')]
 
     def calculate(self):
-        size = min(self.yuv.frames, self.yuvref.frames)
-        x = range(0, size)
-        p = ProcessingPool(cpu_count())
-        for deg, ref in izip(self.yuv, self.yuvref):
-            p.add_task(doSSIM, deg['Y'], ref['Y'])
-        p.join()
-        y = list(p.get_results())
-        self.graph(x, y)
+        self.graphSeries(self.metric)
+        return self.data
+
+class MSSSIM(VQmeasure):
+    '''
+    MS-SSIM: Multi-scale Structural Similarity index (Y component).
+
+    * Type: `plot`.
+    * Units: `MS-SSIM index per frame`.
+    '''
+    def __init__(self, data):
+        VQmeasure.__init__(self, data)
+        self.data['name'] = 'MS-SSIM'
+        self.data['type'] = 'plot'
+        self.data['units'] = ('frame', 'MS-SSIM index')
+        if not self.sample:
+            self.series = [('ms-ssim', 'received', 'original')]
+
+    def calculate(self):
+        self.graphSeries('ms-ssim')
         return self.data
 
 class G1070(VQmeasure):
@@ -260,6 +1021,7 @@ class G1070(VQmeasure):
         self.data['name'] = 'G.1070'
         self.data['type'] = 'value'
         self.data['units'] = ''
+        self.depends = [('qos', 'plr')]
 
     def calculate(self):
         v = [0, 1.431, 2.228e-2, 3.759, 184.1, 1.161, 1.446, 3.881e-4, 2.116, 467.4, 2.736, 15.28, 4.170]
@@ -271,7 +1033,7 @@ class G1070(VQmeasure):
         Ic = Iofr * math.exp(-(math.log(self.conf['framerate']) - math.log(Ofr))**2 / (2 * Dfrv**2))
         Dpplv = v[10] + v[11] * math.exp(-self.conf['framerate'] / v[8]) + v[12] * math.exp(-self.conf['bitrate'] / v[9])
 
-        self.data['value'] = 1 + Ic * math.exp(-self.getQoSm('plr')[0]['value'] * 100 / Dpplv)
+        self.data['value'] = 1 + Ic * math.exp(-self.getDependency('qos', 'plr')['value'] * 100 / Dpplv)
         return self.data
 
 class PSNRtoMOS(VQmeasure):
@@ -286,29 +1048,46 @@ class PSNRtoMOS(VQmeasure):
         self.data['name'] = 'PSNRtoMOS'
         self.data['type'] = 'plot'
         self.data['units'] = ('frame', 'MOS')
-        self.yuv = yuv
-        self.yuvref = yuvref
+        self.video = 'coded' if yuv else 'received'
+        self.ref = 'coded' if yuvref else 'original'
+        self.series = [('psnr', self.video, self.ref)]
+        self.input = (self.conf, self.rawdata[self.video], self.rawdata[self.ref])
 
     def calculate(self):
-        x, y = PSNR((None, self.rawdata, None, None), yuv=self.yuv, yuvref=self.yuvref).calculate()['axes']
-        for i in range(0, len(y)):
-            if y[i] < 20:
-                y[i] = 1
-            elif 20 <= y[i] < 25:
-                y[i] = 2
-            elif 25 <= y[i] < 31:
-                y[i] = 3
-            elif 31 <= y[i] < 37:
-                y[i] = 4
-            else:
-                y[i] = 5
-        self.graph(x, y)
+        x, y = self.getSeries('psnr', self.video, self.ref)
+        self.graph(x, psnrToMOS(y))
         return self.data
 
+def psnrToMOS(psnr):
+    '''
+    Map PSNR values to MOS (see :class:`PSNRtoMOS`).
+
+    :param list psnr: PSNR values.
+
+    :returns: MOS values.
+    :rtype: list
+    '''
+    mos = []
+    for y in psnr:
+        if y < 20:
+            mos.append(1)
+        elif 20 <= y < 25:
+            mos.append(2)
+        elif 25 <= y < 31:
+            mos.append(3)
+        elif 31 <= y < 37:
+            mos.append(4)
+        else:
+            mos.append(5)
+    return mos
+
 class MIV(VQmeasure):
     '''
     MIV metric used on `Evalvid <http://www.tkn.tu-berlin.de/research/evalvid/>`.
 
+    The sliding window counts evaluated frames: if the `step` option is set to `N`,
+    it spans `N` times as many frames of the video.
+
     * Type: `plot`.
     * Units: `Distortion in Interval`.
     '''
@@ -316,19 +1095,40 @@ class MIV(VQmeasure):
         VQmeasure.__init__(self, data)
         self.data['name'] = 'MIV'
         self.data['type'] = 'plot'
-        self.interval = 25
+        #: Sliding window length (evaluated frames), from the `miv_interval` option (default: 25).
+        self.interval = int((self.conf or {}).get('miv_interval', 25))
+        if self.interval < 1:
+            raise Exception('MIV interval must be positive')
         self.data['units'] = ('frame', '% of frames with a MOS worse than the reference')
+        self.series = [('psnr', 'coded', 'original'), ('psnr', 'received', 'original')]
 
     def calculate(self):
-        x, refmos = PSNRtoMOS((None, self.rawdata, None, None), yuv=True).calculate()['axes']
-        x, mos = PSNRtoMOS((None, self.rawdata, None, None)).calculate()['axes']
-        y = [0 for i in range(0, self.interval)]
-        for l in range(0, min(len(refmos), len(mos)) - self.interval):
-            i = 0
-            for j in range(l, l + self.interval):
-                if mos[j] < refmos[j] and mos[j] < 4:
-                    i += 1
-            y.append(100 * float(i) / self.interval)
-        x = [x for x in range(0, len(y))]
+        refmos = psnrToMOS(self.getSeries('psnr', 'coded', 'original')[1])
+        x, mos = self.getSeries('psnr', 'received', 'original')
+        mos = psnrToMOS(mos)
+        y = mivSeries(mos, refmos, self.interval)
+        # Keep the true frame numbers; too short videos are padded with zeros,
+        # at the spacing of the evaluated frames
+        step = (self.conf or {}).get('step') or 1
+        start = x[-1] + step if x else 0
+        x = x[:len(y)] + range(start, start + (len(y) - len(x)) * step, step)
         self.graph(x, y)
         return self.data
+
+def mivSeries(mos, refmos, interval=25):
+    '''
+    Percentage of frames with a MOS worse than the reference (and below 4) in a
+    sliding window, computed as a difference of cumulative sums (see :class:`MIV`).
+
+    :param list mos: MOS values.
+    :param list refmos: Reference MOS values.
+    :param int interval: Window length (frames).
+
+    :returns: A value per window start, preceded by `interval` zeros.
+    :rtype: list
+    '''
+    n = min(len(refmos), len(mos))
+    mos, refmos = np.asarray(mos[:n]), np.asarray(refmos[:n])
+    worse = np.concatenate(([0], np.cumsum((mos < refmos) & (mos < 4))))
+    counts = worse[interval:max(n, interval)] - worse[:max(n - interval, 0)]
+    return [0] * interval + (100. * counts / interval).tolist()
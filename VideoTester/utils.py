@@ -4,8 +4,24 @@
 ## Copyright 2011-2016 Iñaki Úcar <iucar@fedoraproject.org>
 ## This program is published under a GPLv3 license
 
+import os, tempfile, ctypes, ctypes.util
+import numpy as np
 from itertools import izip
-from multiprocessing import Manager, Process, JoinableQueue
+from threading import Thread
+from Queue import Queue, Empty
+from multiprocessing import Process, Queue as ProcessQueue, JoinableQueue
+from . import VTLOG
+
+#: ``posix_fadvise`` advice: expect sequential accesses.
+FADV_SEQUENTIAL = 2
+#: ``posix_fadvise`` advice: expect access in the near future.
+FADV_WILLNEED = 3
+
+try:
+    _fadvise = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).posix_fadvise64
+    _fadvise.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_int]
+except (OSError, AttributeError, TypeError):
+    _fadvise = None
 
 def multiSort(*args):
     '''
@@ -13,42 +29,260 @@ def multiSort(*args):
     '''
     return map(list, izip(*sorted(izip(*args))))
 
+def fadvise(fd, offset, length, advice):
+    '''
+    Announce an intention to access file data (see ``posix_fadvise(2)``).
+    Does nothing if the system does not support it.
+
+    :param int fd: File descriptor.
+    :param int offset: Start of the region.
+    :param int length: Length of the region (0 means until the end of the file).
+    :param int advice: :data:`FADV_SEQUENTIAL` or :data:`FADV_WILLNEED`.
+    '''
+    if _fadvise is not None:
+        _fadvise(fd, offset, length, advice)
+
+class Prefetcher(Thread):
+    '''
+    Background reader that keeps a bounded queue filled with the next items of an iterator.
+    '''
+    def __init__(self, iterable, size, name='prefetch'):
+        '''
+        **On init:** Start reading.
+
+        :param iterable: Items to read ahead.
+        :param int size: Maximum number of items read ahead.
+        :param string name: Name used in the log.
+        '''
+        Thread.__init__(self, name=name)
+        self.daemon = True
+        self.iterable = iterable
+        self.queue = Queue(max(size, 1))
+        #: Items that were ready when requested.
+        self.hits = 0
+        #: Items that had to be waited for.
+        self.misses = 0
+        self.__closed = False
+        self.__reported = False
+        self.start()
+
+    def run(self):
+        try:
+            for item in self.iterable:
+                self.queue.put((True, item))
+                if self.__closed:
+                    return
+            end = StopIteration()
+        except Exception as e:
+            end = e
+        if not self.__closed:
+            self.queue.put((False, end))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            ok, item = self.queue.get_nowait()
+            hit = True
+        except Empty:
+            ok, item = self.queue.get()
+            hit = False
+        if not ok:
+            self.queue.put((ok, item))
+            if isinstance(item, StopIteration):
+                self.__report()
+            raise item
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return item
+
+    def hitrate(self):
+        '''
+        :returns: Fraction of items that were ready when requested.
+        :rtype: float
+        '''
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.
+
+    def close(self):
+        '''
+        Stop reading ahead and wait for the thread to finish. Pending items are dropped.
+        '''
+        if self.__closed:
+            return
+        self.__closed = True
+        self.__drain()
+        self.join()
+        # The thread may have queued one last item before stopping, and
+        # nothing else fills the queue now (it may hold a single item)
+        self.__drain()
+        self.queue.put_nowait((False, StopIteration()))
+        self.__report()
+
+    def __drain(self):
+        try:
+            while True:
+                self.queue.get_nowait()
+        except Empty:
+            pass
+
+    def __report(self):
+        if not self.__reported:
+            self.__reported = True
+            VTLOG.debug('%s: %i hits, %i misses (hit rate %.1f%%)' % (
+                self.name, self.hits, self.misses, 100 * self.hitrate()))
+
+class SharedArray:
+    '''
+    Numpy array in shared memory, backed by a file in ``/dev/shm`` (or in the temporary
+    directory if there is no such filesystem). Pickling it only passes the file name:
+    the receiving process maps the same memory, so results can be written in place.
+    '''
+    def __init__(self, shape, dtype=np.float64, fill=0):
+        '''
+        **On init:** Create and fill the array.
+
+        :param tuple shape: Array shape.
+        :param dtype: Array data type.
+        :param fill: Initial value.
+        '''
+        fd, self.path = tempfile.mkstemp(prefix='VT', suffix='.shm',
+            dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        os.close(fd)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        #: The mapped array.
+        self.array = self.__map('w+')
+        self.array[...] = fill
+
+    def __map(self, mode):
+        if not np.prod(self.shape):
+            return np.empty(self.shape, self.dtype)
+        return np.memmap(self.path, dtype=self.dtype, mode=mode, shape=self.shape)
+
+    def __getstate__(self):
+        return self.path, self.shape, self.dtype
+
+    def __setstate__(self, (path, shape, dtype)):
+        self.path, self.shape, self.dtype = path, shape, dtype
+        self.array = self.__map('r+')
+
+    def close(self):
+        '''
+        Release the memory (every process must have finished with it).
+        '''
+        self.array = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
 class Worker(Process):
-    def __init__(self, qin, lout):
+    def __init__(self, qin, qout):
         Process.__init__(self)
         self.qin = qin
-        self.lout = lout
+        self.qout = qout
         self.daemon = True
         self.start()
 
     def run(self):
         while True:
-            i, func, args, kargs = self.qin.get()
+            task = self.qin.get()
+            if task is None:
+                self.qin.task_done()
+                break
+            i, func, args, kargs = task
+            result = None
             try:
-                self.lout.append((i, func(*args, **kargs)))
+                result = func(*args, **kargs)
             except Exception, e:
                 print e
             finally:
+                self.qout.put((i, result))
                 self.qin.task_done()
 
 class ProcessingPool:
-    def __init__(self, N):
+    '''
+    Pool of worker processes.
+
+    Tasks and results are pickled, so they should be small: to process frames,
+    pass the videos (which are pickled by file name, see :class:`VideoTester.video.YUVVideo`)
+    and the frame numbers, and let the tasks store their results in a :class:`SharedArray`.
+
+    The pool is meant to be long-lived (see :meth:`drain`): workers are started
+    once and keep their state between tasks (module-level buffers, such as those
+    of :data:`VideoTester.measures.vq.ssim`, stay allocated).
+    '''
+    def __init__(self, N, start=True):
+        '''
+        **On init:** Start `N` workers (or wait for the first task if `start` is false).
+        '''
+        #: Number of workers.
+        self.N = N
         self.qin = JoinableQueue(N)
-        self.lout = Manager().list()
+        self.qout = ProcessQueue()
         self.task = 0
+        self.lout = []
         self.workers = []
-        for _ in range(N):
-            self.workers.append(Worker(self.qin, self.lout))
+        if start:
+            self.start()
+
+    def start(self):
+        '''
+        Start the workers, if not running.
+        '''
+        if not self.workers:
+            VTLOG.debug('Starting %i worker processes' % self.N)
+            for _ in range(self.N):
+                self.workers.append(Worker(self.qin, self.qout))
 
     def add_task(self, func, *args, **kargs):
+        '''
+        Queue a call to `func` (it must be picklable, e.g. a module-level function).
+        '''
+        self.start()
         self.qin.put((self.task, func, args, kargs))
         self.task += 1
 
     def join(self):
+        '''
+        Wait until all the queued tasks are done.
+        '''
         self.qin.join()
 
     def get_results(self, ordered=True):
+        '''
+        :returns: The return values of the tasks (``None`` for failed ones).
+        :rtype: tuple
+        '''
+        while len(self.lout) < self.task:
+            self.lout.append(self.qout.get())
         if ordered:
-            return zip(*sorted(self.lout))[1]
-        else:
-            return zip(*self.lout)[1]
+            self.lout.sort()
+        return tuple(result for _, result in self.lout)
+
+    def drain(self):
+        '''
+        Wait until all the queued tasks are done and forget them, so that the pool
+        can be reused for another job.
+
+        :returns: The return values of the tasks, in order (see :meth:`get_results`).
+        :rtype: tuple
+        '''
+        results = self.get_results()
+        self.task = 0
+        self.lout = []
+        return results
+
+    def shutdown(self):
+        '''
+        Stop the workers once the queued tasks are done. The pool can be started again.
+        '''
+        for _ in self.workers:
+            self.qin.put(None)
+        for worker in self.workers:
+            worker.join()
+        if self.workers:
+            VTLOG.debug('Stopped %i worker processes' % self.N)
+        self.workers = []
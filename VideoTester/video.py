@@ -4,13 +4,52 @@
 ## Copyright 2011-2016 Iñaki Úcar <iucar@fedoraproject.org>
 ## This program is published under a GPLv3 license
 
+import os, hashlib, mmap, copy, tempfile
 import numpy as np
+from itertools import izip
+from . import VTLOG
+from .utils import Prefetcher, fadvise, FADV_SEQUENTIAL, FADV_WILLNEED
+
+#: Frame type names, indexed by the `type` codes of :data:`frametable`.
+frametypes = ['I', 'P', 'B', 'S', 'SP', 'SI']
+
+#: Row type of :attr:`CodedVideo.table`: `offset` and `length` (in bytes) and
+#: `type` code (see :data:`frametypes`) of each frame. The length of the last
+#: frame is 0 if its end was not found and the type is 255 if it is unknown.
+frametable = np.dtype([('offset', np.int64), ('length', np.int64), ('type', np.uint8)])
+
+#: Supported raw formats (GStreamer names). For each one: sample type, bit depth
+#: and list of planes as stored in memory. Each plane is given by its components
+#: (more than one if interleaved) and their horizontal and vertical subsampling.
+yuvformats = {
+    'I420':      (np.uint8, 8,  [('Y', 1, 1), ('U', 2, 2), ('V', 2, 2)]),
+    'YV12':      (np.uint8, 8,  [('Y', 1, 1), ('V', 2, 2), ('U', 2, 2)]),
+    'NV12':      (np.uint8, 8,  [('Y', 1, 1), ('UV', 2, 2)]),
+    'NV21':      (np.uint8, 8,  [('Y', 1, 1), ('VU', 2, 2)]),
+    'Y42B':      (np.uint8, 8,  [('Y', 1, 1), ('U', 2, 1), ('V', 2, 1)]),
+    'Y444':      (np.uint8, 8,  [('Y', 1, 1), ('U', 1, 1), ('V', 1, 1)]),
+    'I420_10LE': ('<u2',    10, [('Y', 1, 1), ('U', 2, 2), ('V', 2, 2)]),
+    'I422_10LE': ('<u2',    10, [('Y', 1, 1), ('U', 2, 1), ('V', 2, 1)]),
+    'Y444_10LE': ('<u2',    10, [('Y', 1, 1), ('U', 1, 1), ('V', 1, 1)])
+}
 
 class YUVVideo:
     '''
     YUV parser.
+
+    The file is memory-mapped and every plane is exposed as a numpy view over
+    the mapping, so no data is copied or read from disk until it is accessed.
+    Frames can be iterated (``for frame in video``) or indexed (``video[i]``,
+    ``video[-1]``, ``video[a:b:step]``).
+
+    If :attr:`prefetch` is set, iteration (also with :meth:`blocks` and :meth:`read`)
+    faults the upcoming frames in from a background thread, so that disk reads
+    overlap with the processing of the current frame.
+
+    Videos are pickled by file name, format and region of interest, so they can be
+    passed to worker processes, which map the file themselves.
     '''
-    def __init__(self, file, (width, height, fmt)):
+    def __init__(self, file, (width, height, fmt), prefetch=0):
         '''
         **On init:** Call the proper parser.
 
@@ -18,65 +57,369 @@ class YUVVideo:
         :param int width: Frame width.
         :param int height: Frame height.
         :param string format: YUV format.
+        :param int prefetch: Number of items read ahead while iterating (0 to disable).
 
         .. note::
-            Supported formats: I420.
+            Supported formats: see :data:`yuvformats`.
         '''
+        #: Path to the file.
+        self.file = file
         #: Frame width.
         self.width = width
         #: Frame height.
         self.height = height
-        #: File descriptor.
-        self.f = open(file, 'rb')
-
-        if fmt == 'I420':
-            frame = self.width * self.height
-            self.yblock = frame
-            self.uvblock = frame / 4
-            self.chunk = self.yblock + 2 * self.uvblock
-        else:
+        #: YUV format.
+        self.format = fmt
+        self.__size = (width, height)
+        #: Region of interest ``(x, y, width, height)`` if cropped (see :meth:`crop`).
+        self.roi = None
+        #: Number of items read ahead while iterating (0 to disable).
+        self.prefetch = prefetch
+        #: Last :class:`VideoTester.utils.Prefetcher` used (hit rate statistics).
+        self.prefetcher = None
+
+        if fmt not in yuvformats:
             raise IOError('Format %s not supported' % fmt)
+        dtype, depth, planes = yuvformats[fmt]
+        #: Sample bit depth.
+        self.depth = depth
+        #: Peak sample value.
+        self.peak = 2**depth - 1
+        size = np.dtype(dtype).itemsize
+        layout = []
+        self.chunk = 0
+        for components, wdiv, hdiv in planes:
+            rows, cols, step = height / hdiv, width / wdiv, len(components)
+            for i, component in enumerate(components):
+                layout.append((component, self.chunk + i * size, rows, cols, step))
+            self.chunk += rows * cols * step * size
 
-        self.f.seek(0, 2)
         #: Number of frames in the video.
-        self.frames = self.f.tell()/self.chunk
-        self.f.seek(0)
+        self.frames = os.path.getsize(file)/self.chunk
+        if self.frames:
+            buf = np.memmap(file, dtype=np.uint8, mode='r', shape=(self.frames * self.chunk,))
+        else:
+            buf = np.zeros(self.chunk, dtype=np.uint8)
+        self.__buf = buf
+        #: Dictionary of ``(frames, rows, columns)`` views over the mapping, one per plane.
+        self.planes = {}
+        for component, offset, rows, cols, step in layout:
+            self.planes[component] = np.ndarray(
+                shape=(self.frames, rows, cols), dtype=dtype, buffer=buf,
+                offset=offset, strides=(self.chunk, cols * step * size, step * size))
+        self.__source = None
+        self.__fingerprints = {}
+        self.__differences = {}
+        self.__alignments = {}
+
+    def __len__(self):
+        return self.frames
+
+    def __getstate__(self):
+        # Pickled by name: the receiving process maps the file again
+        return self.file, self.__size, self.format, self.prefetch, self.roi
+
+    def __setstate__(self, (file, size, fmt, prefetch, roi)):
+        self.__init__(file, size + (fmt,), prefetch)
+        if roi:
+            self.__dict__.update(self.crop(roi).__dict__)
+
+    def __getitem__(self, key):
+        '''
+        Get a frame (integer key) or a stack of frames (slice or index array).
+
+        :returns: A dictionary of ``Y``, ``U`` and ``V`` arrays, views over the mapping
+            unless indexed with an array. Frame stacks have an extra leading axis.
+        :rtype: dict
+        '''
+        if isinstance(key, (int, long, np.integer)):
+            if key < 0:
+                key += self.frames
+            if not 0 <= key < self.frames:
+                raise IndexError('frame index out of range')
+        return dict((plane, data[key]) for plane, data in self.planes.iteritems())
+
+    def blocks(self, n=16, ref=None):
+        '''
+        Iterate over blocks of consecutive frames.
+
+        :param int n: Number of frames per block.
+        :param ref: Reference video, read in lock-step.
+        :type ref: YUVVideo
+
+        :returns: An iterator of frame stacks (see :meth:`__getitem__`) of up to `n` frames,
+            or of ``(block, reference block)`` pairs if `ref` is given.
+        '''
+        if ref is None:
+            return self.read(slice(i, i+n) for i in xrange(0, self.frames, n))
+        frames = min(self.frames, ref.frames)
+        keys = [slice(i, min(i + n, frames)) for i in xrange(0, frames, n)]
+        return izip(self.read(keys), ref.read(keys))
+
+    def read(self, keys):
+        '''
+        Iterate over the given frames or frame stacks, reading ahead if :attr:`prefetch` is set.
+
+        :param keys: Sequence of keys (see :meth:`__getitem__`).
+
+        :returns: An iterator of frames or frame stacks.
+        '''
+        if not self.prefetch:
+            return (self[key] for key in keys)
+        self.prefetcher = Prefetcher(self.__readahead(list(keys)), self.prefetch,
+            'Prefetch %s' % os.path.basename(self.file))
+        return self.prefetcher
+
+    def __span(self, key):
+        '''
+        :returns: First and last byte (exclusive) spanned by a key (see :meth:`__getitem__`).
+        :rtype: tuple
+        '''
+        if isinstance(key, slice):
+            indexes = xrange(*key.indices(self.frames))
+            indexes = [indexes[0], indexes[-1]] if indexes else []
+        elif isinstance(key, (int, long, np.integer)):
+            indexes = [key]
+        else:
+            indexes = key
+        indexes = [i + self.frames if i < 0 else i for i in indexes]
+        if not indexes:
+            return 0, 0
+        return min(indexes) * self.chunk, (max(indexes) + 1) * self.chunk
+
+    def __readahead(self, keys):
+        '''
+        Fault in and yield the frames of `keys` one after another, after
+        hinting the kernel about the next :attr:`prefetch` ones.
+        '''
+        spans = [self.__span(key) for key in keys]
+        with open(self.file, 'rb') as f:
+            fd = f.fileno()
+            fadvise(fd, 0, 0, FADV_SEQUENTIAL)
+            for start, stop in spans[:self.prefetch]:
+                fadvise(fd, start, stop - start, FADV_WILLNEED)
+            for i, key in enumerate(keys):
+                if i + self.prefetch < len(spans):
+                    start, stop = spans[i + self.prefetch]
+                    fadvise(fd, start, stop - start, FADV_WILLNEED)
+                start, stop = spans[i]
+                if stop > start:
+                    # Touch one byte per page
+                    self.__buf[start:stop:mmap.PAGESIZE].max()
+                yield self[key]
+
+    def crop(self, (x, y, width, height)):
+        '''
+        Restrict the video to a region of interest.
+
+        :param int x: Left column.
+        :param int y: Top row.
+        :param int width: Region width.
+        :param int height: Region height.
+
+        :returns: A new video sharing the mapping, whose planes are views of the region.
+            Chroma planes cover the region scaled by their subsampling, so coordinates
+            should be multiples of it.
+        :rtype: YUVVideo
+        '''
+        video = copy.copy(self)
+        video.width, video.height = width, height
+        video.roi = (x + self.roi[0], y + self.roi[1], width, height) if self.roi \
+            else (x, y, width, height)
+        video.planes = {}
+        for component, data in self.planes.iteritems():
+            wdiv, hdiv = self.width / data.shape[2], self.height / data.shape[1]
+            video.planes[component] = data[:, y/hdiv:(y+height)/hdiv, x/wdiv:(x+width)/wdiv]
+        video.prefetcher = None
+        video.__source = None
+        video.__fingerprints = {}
+        video.__differences = {}
+        video.__alignments = {}
+        return video
+
+    def fingerprints(self, size=8):
+        '''
+        Compute cheap signatures of every frame (cached).
+
+        :param int size: Side of the thumbnails.
+
+        :returns: ``(frames, size * size)`` luma thumbnails (block means, normalized
+            to the peak value) and the hash of each thumbnail quantized to 16 levels.
+        :rtype: tuple
+        '''
+        if size not in self.__fingerprints:
+            size = max(min(size, self.width, self.height), 1)
+            bh, bw = self.height / size, self.width / size
+            thumbs = np.empty((self.frames, size * size), dtype=np.float32)
+            i = 0
+            for block in self.blocks():
+                Y = block['Y'][:, :size*bh, :size*bw].reshape(-1, size, bh, size, bw)
+                thumbs[i:i+len(Y)] = Y.mean(axis=(2, 4), dtype=np.float32).reshape(len(Y), -1)
+                i += len(Y)
+            thumbs /= self.peak
+            levels = np.rint(thumbs * 15).astype(np.uint8)
+            hashes = np.array([hash(x.tostring()) for x in levels], dtype=np.int64)
+            self.__fingerprints[size] = thumbs, hashes
+        return self.__fingerprints[size]
+
+    def differences(self, step=4, frames=None, n=16):
+        '''
+        Compute the mean absolute luma difference between each frame and the previous
+        one (cached). Only one pixel out of `step` in each direction is compared.
+
+        :param int step: Subsampling step.
+        :param tuple frames: If given as ``(first, last)``, only frames in ``[first, last)``
+            are compared (the rest are never read, except the one before `first`).
+        :param int n: Number of frames per block.
+
+        :returns: An array of differences (``inf`` for the first frame and for frames
+            not compared).
+        :rtype: numpy.ndarray
+        '''
+        first, last, _ = slice(*(frames or (None, None))).indices(self.frames)
+        key = (step, first, last)
+        if key not in self.__differences:
+            diffs = np.empty(self.frames)
+            diffs.fill(np.inf)
+            previous = None
+            i = max(first - 1, 0)
+            for block in self.read(slice(j, min(j + n, last)) for j in xrange(i, last, n)):
+                Y = block['Y'][:, ::step, ::step].astype(np.int16)
+                k = len(Y)
+                if previous is not None:
+                    Y = np.concatenate((previous, Y))
+                if len(Y) > 1:
+                    d = np.abs(np.diff(Y, axis=0)).reshape(len(Y) - 1, -1).mean(axis=1)
+                    diffs[i+k-len(d):i+k] = d
+                previous = Y[-1:]
+                i += k
+            self.__differences[key] = diffs
+        return self.__differences[key]
+
+    def align(self, ref, band=50, skip=0.01, repeat=0.01):
+        '''
+        Find the reference frame that matches each frame, allowing for lost and repeated frames (cached).
+
+        Frames are compared by their :meth:`fingerprints` (mean absolute difference of
+        the thumbnails, zero if the hashes match) and the best monotonic match is found
+        by dynamic programming. Only `band` reference frames around the diagonal (scaled
+        to the length of both videos) are considered for each frame, so the cost is linear
+        in the number of frames.
+
+        :param ref: Reference video.
+        :type ref: YUVVideo
+        :param int band: Maximum distance to the diagonal (in frames).
+        :param float skip: Penalty for each reference frame left unmatched (lost).
+        :param float repeat: Penalty for matching a reference frame again (repeated).
+
+        :returns: The index of the matching reference frame for each frame.
+        :rtype: numpy.ndarray
+        '''
+        key = (ref, band, skip, repeat)
+        if key in self.__alignments:
+            return self.__alignments[key]
+        m, n = self.frames, ref.frames
+        if not m or not n:
+            return np.zeros(0, dtype=np.intp)
+        thumbs, hashes = self.fingerprints()
+        rthumbs, rhashes = ref.fingerprints()
+        w = 2 * band + 1
+        k = np.arange(w)
+        # First reference frame in the band of each frame
+        starts = np.arange(m) * (n - 1) / max(m - 1, 1) - band
+        back = np.empty((m, w), dtype=np.min_scalar_type(w))
+        for i in xrange(m):
+            if i % 1024 == 0:
+                # Distances for the next rows of the band
+                j = starts[i:i+1024, np.newaxis] + k
+                jc = j.clip(0, n - 1)
+                dist = np.abs(rthumbs[jc] - thumbs[i:i+1024, np.newaxis]).mean(axis=2)
+                dist[rhashes[jc] == hashes[i:i+1024, np.newaxis]] = 0
+                dist[(j < 0) | (j >= n)] = np.inf
+            if i == 0:
+                # Reference frames before the first match are lost
+                cost = dist[0] + (starts[0] + k) * skip
+                continue
+            delta = starts[i] - starts[i-1]
+            # Best previous match p < q = k + delta (band position of the same
+            # reference frame in the previous row), each frame in between lost
+            A = cost - k * skip
+            best = np.minimum.accumulate(A)
+            arg = np.maximum.accumulate(np.where(A == best, k, 0))
+            q = k + delta - 1
+            qc = q.clip(0, w - 1)
+            move = np.where(q >= 0, best[qc] + q * skip, np.inf)
+            # Same reference frame as the previous one
+            r = k + delta
+            same = np.where(r < w, cost[r.clip(0, w - 1)] + repeat, np.inf)
+            back[i] = np.where(move <= same, arg[qc], r.clip(0, w - 1))
+            cost = np.minimum(move, same) + dist[i % 1024]
+        # Reference frames after the last match are lost
+        p = np.argmin(cost + (n - 1 - starts[-1] - k) * skip)
+        index = np.empty(m, dtype=np.intp)
+        for i in xrange(m - 1, -1, -1):
+            index[i] = starts[i] + p
+            p = back[i, p]
+        self.__alignments[key] = index
+        return index
 
     def __iter__(self):
-        self.f.seek(0)
+        if isinstance(self.__source, Prefetcher):
+            self.__source.close()
+        self.__source = self.read(xrange(self.frames))
         return self
 
     def next(self):
-        data = self.f.read(self.chunk)
-        if not data:
-            raise StopIteration
-        else:
-            yu = self.yblock
-            uv = self.yblock + self.uvblock
-            return {
-                'Y' : np.frombuffer(data[0:yu], dtype=np.uint8).reshape(self.height, self.width),
-                'U' : np.frombuffer(data[yu:uv], dtype=np.uint8).reshape(self.height/2, self.width/2),
-                'V' : np.frombuffer(data[uv:], dtype=np.uint8).reshape(self.height/2, self.width/2)
-            }
+        if self.__source is None:
+            self.__iter__()
+        return self.__source.next()
 
 class CodedVideo:
     '''
     Coded video parser.
+
+    The file is read in windows of :attr:`window` bytes. Each window carries over
+    the last few bytes of the previous one, so start codes crossing a window
+    boundary are still found and memory usage is bounded by the window size.
+
+    The resulting frame table (see :attr:`table`) is stored in a sidecar file next
+    to the bitstream (see :attr:`index`) and reused as long as the bitstream does
+    not change. The dictionary of `types` and `lengths` lists used by older code
+    is still available as ``frames``, built from the table on first access.
     '''
-    def __init__(self, file, codec):
+    def __init__(self, file, codec, window=2**26, cache=True, prefetch=0):
         '''
         **On init:** Call the proper parser.
 
         :param string file: Path to the file.
         :param string codec: Codec type.
+        :param int window: Size of the read window (in bytes).
+        :param boolean cache: Whether to load and store the frame index sidecar.
+        :param int prefetch: Number of windows read ahead by a background thread (0 to disable).
 
         .. note::
             Supported formats: H263, H264, MPEG4 and Theora.
         '''
-        #: Numpy np.array with all the data.
-        self.raw = np.fromfile(file, dtype=np.uint8)
-        #: Dictionary that contains the `types` and the `lengths` for all the frames found.
-        self.frames = {'types':[], 'lengths':[]}
+        #: Path to the file.
+        self.file = file
+        #: Codec type.
+        self.codec = codec
+        #: Size of the read window (in bytes).
+        self.window = max(window, 4096)
+        #: Number of windows read ahead by a background thread (0 to disable).
+        self.prefetch = prefetch
+        #: Path to the frame index sidecar.
+        self.index = file + '.idx'
+        #: Frame table (see :data:`frametable`).
+        self.table = np.zeros(0, dtype=frametable)
+        key = self.__signature()
+        if cache and self.__load(key):
+            VTLOG.debug('Frame index loaded from %s' % self.index)
+            return
+        # Start of each frame in `lengths`, plus the start of the last one
+        self.__offsets = []
+        self.__lengths = []
+        self.__types = []
         if codec == 'h263':
             self.__parseH263()
         elif codec == 'h264':
@@ -87,26 +430,164 @@ class CodedVideo:
             self.__parseTheora()
         else:
             raise IOError('Format %s not supported' % codec)
+        n = max(len(self.__lengths), len(self.__types))
+        self.table = np.zeros(n, dtype=frametable)
+        self.table['offset'] = self.__offsets[-1]
+        self.table['offset'][:len(self.__lengths)] = self.__offsets[:-1]
+        self.table['length'][:len(self.__lengths)] = self.__lengths
+        self.table['type'] = 0xff
+        self.table['type'][:len(self.__types)] = [frametypes.index(x) for x in self.__types]
+        del self.__offsets, self.__lengths, self.__types
+        if cache:
+            self.__save(key)
+
+    def __getattr__(self, name):
+        if name == 'frames':
+            # Compatibility view of the frame table, built on first access
+            self.frames = {
+                'types': [frametypes[x] for x in self.table['type'][self.table['type'] != 0xff]],
+                'lengths': self.table['length'][self.table['length'] > 0].tolist()
+            }
+            return self.frames
+        raise AttributeError(name)
+
+    def __signature(self):
+        '''
+        Identify the current contents of the file.
+
+        :returns: File size, modification time, SHA-1 of the first and last MiB, and codec.
+        :rtype: tuple
+        '''
+        size = os.path.getsize(self.file)
+        sha = hashlib.sha1()
+        with open(self.file, 'rb') as f:
+            sha.update(f.read(2**20))
+            f.seek(max(size - 2**20, 0))
+            sha.update(f.read(2**20))
+        return size, os.path.getmtime(self.file), sha.hexdigest(), self.codec
+
+    def __load(self, key):
+        '''
+        Load the frame index from the sidecar file if it matches the bitstream.
+
+        :param tuple key: Bitstream signature (see :meth:`__signature`).
+
+        :returns: True if the index was loaded.
+        :rtype: boolean
+        '''
+        try:
+            with open(self.index, 'rb') as f:
+                data = np.load(f)
+                if tuple(data['key'].tolist()) != tuple(map(repr, key)):
+                    return False
+                self.table = data['table']
+        except Exception:
+            # Missing, stale or damaged (e.g. truncated) sidecar: rebuild it
+            return False
+        return True
+
+    def __save(self, key):
+        '''
+        Store the frame index in the sidecar file. It is written to a temporary
+        file first and then renamed, so that an interrupted run never leaves a
+        partial index behind.
+
+        :param tuple key: Bitstream signature (see :meth:`__signature`).
+        '''
+        temp = None
+        try:
+            fd, temp = tempfile.mkstemp(dir=os.path.dirname(self.index) or '.',
+                prefix=os.path.basename(self.index) + '.')
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f,
+                    key=np.array(map(repr, key)),
+                    table=self.table)
+            os.rename(temp, self.index)
+        except (IOError, OSError) as e:
+            VTLOG.warning('Cannot write frame index: %s' % e)
+            if temp and os.path.exists(temp):
+                os.remove(temp)
+
+    def __scan(self, patterns, tail, lookahead, lookbehind=0):
+        '''
+        Find pattern occurrences window by window.
+
+        :param list patterns: List of ``(pattern, mask)`` pairs (see :func:`findPattern`).
+        :param int tail: Occurrences are only reported if they start more than `tail` bytes before the end of the file.
+        :param int lookahead: Bytes that the parser reads from the start of an occurrence.
+        :param int lookbehind: Bytes that the parser reads before the start of an occurrence.
+
+        :returns: An iterator of ``(window, position in window, position in file)`` in file order.
+        '''
+        size = os.path.getsize(self.file)
+        end = size - tail
+        buf = np.empty(0, dtype=np.uint8)
+        base = 0
+        done = 0
+        with open(self.file, 'rb') as f:
+            windows = self.__windows(f)
+            if self.prefetch:
+                windows = Prefetcher(windows, self.prefetch,
+                    'Prefetch %s' % os.path.basename(self.file))
+            try:
+                for data in windows:
+                    buf = np.concatenate((buf, data))
+                    last = base + len(buf) >= size
+                    if last:
+                        stop = end
+                    else:
+                        stop = min(end, base + len(buf) - lookahead)
+                    found = reduce(np.union1d, [findPattern(buf, p, m, stop - base) for p, m in patterns])
+                    for j in found[found >= done - base].tolist():
+                        yield buf, j, base + j
+                    if last:
+                        break
+                    done = max(done, stop)
+                    keep = max(done - lookbehind - base, 0)
+                    buf = buf[keep:]
+                    base += keep
+            finally:
+                if self.prefetch:
+                    windows.close()
+
+    def __windows(self, f):
+        '''
+        Read a file window by window, hinting the kernel about the next :attr:`prefetch` windows.
+
+        :param file f: Open file.
+
+        :returns: An iterator of windows, the last one shorter than :attr:`window` (possibly empty).
+        '''
+        fd = f.fileno()
+        fadvise(fd, 0, 0, FADV_SEQUENTIAL)
+        while True:
+            fadvise(fd, f.tell(), self.window * (self.prefetch + 1), FADV_WILLNEED)
+            data = np.fromfile(f, dtype=np.uint8, count=self.window)
+            yield data
+            if len(data) < self.window:
+                break
 
     def __parseH263(self):
         '''
         H263 format parser.
         '''
-        PSC = np.array([0x00, 0x00, 0x80], dtype=np.uint8)
-        mask = np.array([0xff, 0xff, 0xfc], dtype=np.uint8)
+        PSC = [0x00, 0x00, 0x80]
+        mask = [0xff, 0xff, 0xfc]
         first = -1
-        i = 0
-        while i < len(self.raw)-3:
-            if np.all((self.raw[i:i+3] & mask) == PSC):
-                if (i != 0) and (first > -1):
-                    self.frames['lengths'].append(i-first)
-                first = i
-                i += 4
-                if (self.raw[i] & 0x02) == 0:
-                    self.frames['types'].append('I')
-                else:
-                    self.frames['types'].append('P')
-            i += 1
+        next = 0
+        for buf, j, i in self.__scan([(PSC, mask)], 3, 5):
+            if i < next:
+                continue
+            if (i != 0) and (first > -1):
+                self.__lengths.append(i-first)
+                self.__offsets.append(first)
+            first = i
+            if (buf[j+4] & 0x02) == 0:
+                self.__types.append('I')
+            else:
+                self.__types.append('P')
+            next = i + 5
+        self.__offsets.append(first)
 
     def __parseH264(self):
         '''
@@ -146,81 +627,127 @@ class CodedVideo:
                 type = 'SI'
             return type
 
-        SC = np.array([0x00, 0x00, 0x00, 0x01], dtype=np.uint8)
-        SCmask = np.array([0xff, 0xff, 0xff, 0xff], dtype=np.uint8)
+        SC = [0x00, 0x00, 0x00, 0x01]
         typeI = 0x05
         typePB = 0x01
         typemask = 0x1f
         flag = True
         first = 0
-        i = 0
-        while i < len(self.raw)-4:
-            if np.all((self.raw[i:i+4] & SCmask) == SC):
-                if flag:
-                    if i != 0:
-                        self.frames['lengths'].append(i-first)
-                    first = i
-                    flag = False
-                i += 4
-                if ((self.raw[i] & typemask) == typeI) or ((self.raw[i] & typemask) == typePB):
-                    flag = True
-                    i += 1
-                    self.frames['types'].append(getType(self.raw[i:i+1]))
-            i += 1
+        next = 0
+        for buf, j, i in self.__scan([(SC, None)], 4, 6):
+            if i < next:
+                continue
+            if flag:
+                if i != 0:
+                    self.__lengths.append(i-first)
+                    self.__offsets.append(first)
+                first = i
+                flag = False
+            next = i + 5
+            if ((buf[j+4] & typemask) == typeI) or ((buf[j+4] & typemask) == typePB):
+                flag = True
+                self.__types.append(getType(buf[j+5]))
+                next = i + 6
+        self.__offsets.append(first)
 
     def __parseMPEG4(self):
         '''
         MPEG4 format parser.
         '''
-        SC = np.array([0x00, 0x00, 0x01, 0xb6], dtype=np.uint8)
-        mask = np.array([0xff, 0xff, 0xff, 0xff], dtype=np.uint8)
+        SC = [0x00, 0x00, 0x01, 0xb6]
         first = -1
-        i = 0
-        while i < len(self.raw)-4:
-            if np.all((self.raw[i:i+4] & mask) == SC):
-                if (i != 0) and (first > -1):
-                    self.frames['lengths'].append(i-first)
-                first = i
-                i += 4
-                comp = self.raw[i] & 0xc0
-                if comp == 0x00:
-                    self.frames['types'].append('I')
-                elif comp == 0x40:
-                    self.frames['types'].append('P')
-                elif comp == 0x80:
-                    self.frames['types'].append('B')
-                elif comp == 0xc0:
-                    self.frames['types'].append('S')
-            i += 1
+        next = 0
+        for buf, j, i in self.__scan([(SC, None)], 4, 5):
+            if i < next:
+                continue
+            if (i != 0) and (first > -1):
+                self.__lengths.append(i-first)
+                self.__offsets.append(first)
+            first = i
+            comp = buf[j+4] & 0xc0
+            if comp == 0x00:
+                self.__types.append('I')
+            elif comp == 0x40:
+                self.__types.append('P')
+            elif comp == 0x80:
+                self.__types.append('B')
+            elif comp == 0xc0:
+                self.__types.append('S')
+            next = i + 5
+        self.__offsets.append(first)
 
     def __parseTheora(self):
         '''
         Theora over Matroska format parser.
         '''
-        SC1 = [np.array([0xa3, 0x00, 0x00, 0x81, 0x00, 0x00, 0x00], dtype=np.uint8),
-                np.array([0xa3, 0x00, 0x00, 0x81, 0x00, 0x00, 0x80], dtype=np.uint8),
-                np.array([0xa3, 0x00, 0x81, 0x00, 0x00, 0x00], dtype=np.uint8)]
-        mask1 = [np.array([0xff, 0x00, 0x00, 0xff, 0x00, 0x00, 0xff], dtype=np.uint8),
-                np.array([0xff, 0x00, 0xff, 0x00, 0x00, 0xff], dtype=np.uint8)]
-        SC2 = np.array([0x1f, 0x43, 0xb6, 0x75], dtype=np.uint8)
-        mask2 = np.array([0xff, 0xff, 0xff, 0xff], dtype=np.uint8)
+        def match(buf, j, pattern, mask):
+            return np.all((buf[j:j+len(pattern)] & mask) == pattern)
+
+        SC1 = [[0xa3, 0x00, 0x00, 0x81, 0x00, 0x00, 0x00],
+                [0xa3, 0x00, 0x00, 0x81, 0x00, 0x00, 0x80],
+                [0xa3, 0x00, 0x81, 0x00, 0x00, 0x00]]
+        mask1 = [[0xff, 0x00, 0x00, 0xff, 0x00, 0x00, 0xff],
+                [0xff, 0x00, 0xff, 0x00, 0x00, 0xff]]
+        SC2 = [0x1f, 0x43, 0xb6, 0x75]
+        patterns = [(SC1[0], mask1[0]), (SC1[1], mask1[0]), (SC1[2], mask1[1]), (SC2, None)]
         first = -1
-        i = 0
-        while i < len(self.raw)-7:
-            if np.all((self.raw[i:i+7] & mask1[0]) == SC1[0]) or np.all((self.raw[i:i+7] & mask1[0]) == SC1[1]) or np.all((self.raw[i:i+6] & mask1[1]) == SC1[2]):
-                if not np.all((self.raw[i:i+7] & mask1[0]) == SC1[1]):
-                    self.frames['lengths'].append(i-first)
-                if not np.all((self.raw[i:i+6] & mask1[1]) == SC1[2]):
-                    i += 7
+        next = 0
+        for buf, j, i in self.__scan(patterns, 7, 8, 6):
+            if i < next:
+                continue
+            if buf[j] == SC1[0][0]:
+                if not match(buf, j, SC1[1], mask1[0]):
+                    self.__lengths.append(i-first)
+                    self.__offsets.append(first)
+                if not match(buf, j, SC1[2], mask1[1]):
+                    i, j = i + 7, j + 7
                 else:
-                    i += 6
+                    i, j = i + 6, j + 6
                 first = i
-                if self.raw[i] & 0x40 == 0:
-                    self.frames['types'].append('I')
+                if buf[j] & 0x40 == 0:
+                    self.__types.append('I')
                 else:
-                    self.frames['types'].append('P')
-                i += 1
-            elif np.all((self.raw[i:i+4] & mask2) == SC2):
-                if not self.raw[i-6:i-1].tostring() == 'Video':
-                    self.frames['lengths'].append(i-first)
-            i += 1
+                    self.__types.append('P')
+                next = i + 2
+            elif not buf[j-6:j-1].tostring() == 'Video':
+                self.__lengths.append(i-first)
+                self.__offsets.append(first)
+        self.__offsets.append(first)
+
+def findPattern(data, pattern, mask=None, end=None):
+    '''
+    Find all the occurrences of a byte pattern in a single vectorized pass.
+
+    The most selective byte of the pattern is searched first over the whole
+    array and the remaining bytes are only checked at the candidate offsets.
+
+    :param data: Array of bytes.
+    :type data: numpy.ndarray
+    :param list pattern: Byte values to look for.
+    :param list mask: Bit mask applied to each data byte before comparing (default: all bits).
+    :param int end: Only report occurrences starting before this offset.
+
+    :returns: Sorted offsets of the occurrences.
+    :rtype: numpy.ndarray
+    '''
+    if mask is None:
+        mask = [0xff] * len(pattern)
+    n = len(data) - len(pattern) + 1
+    if end is not None:
+        n = min(n, end)
+    if n <= 0:
+        return np.empty(0, dtype=np.intp)
+    checks = [k for k in range(len(pattern)) if mask[k]]
+    # Non-zero bytes are far less frequent than zeros in a bitstream
+    checks.sort(key=lambda k: (pattern[k] & mask[k] != 0, bin(mask[k]).count('1')), reverse=True)
+    k = checks[0]
+    window = data[k:k+n]
+    if mask[k] != 0xff:
+        window = window & mask[k]
+    found = np.flatnonzero(window == pattern[k])
+    for k in checks[1:]:
+        window = data[found + k]
+        if mask[k] != 0xff:
+            window &= mask[k]
+        found = found[window == pattern[k]]
+    return found
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# coding=UTF8
+## This file is part of VideoTester
+## See https://github.com/Enchufa2/video-tester for more information
+## Copyright 2011-2016 Iñaki Úcar <iucar@fedoraproject.org>
+## This program is published under a GPLv3 license
+
+# Description: micro-benchmarks of the VideoTester processing stages on synthetic data
+
+import sys, os, time, tempfile, threading
+import numpy as np
+from multiprocessing import cpu_count
+from VideoTester import CodedVideo, YUVVideo, ProcessingPool
+from VideoTester.measures.qos import Delta, Jitter, Skew, Bandwidth, PacketLossRate, PacketLossDist
+from VideoTester.measures.vq import blockPSNR, doSSIM, doMSSSIM, ssimScale, VQengine, mivSeries
+
+def timeit(func, *args):
+  start = time.time()
+  res = func(*args)
+  return time.time() - start, res
+
+def synthetic_h264(name, size):
+  # Random payload with a start code + slice header every ~4 kB
+  rng = np.random.RandomState(0)
+  data = rng.randint(1, 256, size=size).astype(np.uint8)
+  for i in xrange(0, size - 8, 4096):
+    data[i:i+6] = [0x00, 0x00, 0x00, 0x01, 0x01, 0x9a]
+  data.tofile(name)
+
+def bytewise_h264(raw):
+  # Byte-at-a-time scan, as done before the vectorized parsers
+  SC = np.array([0x00, 0x00, 0x00, 0x01], dtype=np.uint8)
+  count = 0
+  i = 0
+  while i < len(raw)-4:
+    if np.all(raw[i:i+4] == SC):
+      count += 1
+      i += 5
+    i += 1
+  return count
+
+def parsers(args):
+  '''parsers [MB ...]: CodedVideo parsing speed (default: 1 10 100 1000 MB)'''
+  sizes = map(int, args) or [1, 10, 100, 1000]
+  name = os.path.join(tempfile.gettempdir(), 'VTbench.h264')
+  for mb in sizes:
+    synthetic_h264(name, mb * 2**20)
+    t, video = timeit(lambda: CodedVideo(name, 'h264', cache=False))
+    print '%6i MB: %8.3f s (%8.1f MB/s), %i frames' % (mb, t, mb / t, len(video.frames['lengths']))
+    CodedVideo(name, 'h264')
+    t, _ = timeit(CodedVideo, name, 'h264')
+    print '%6i MB: %8.3f s (%8.1f MB/s), cached index' % (mb, t, mb / t)
+    os.remove(name + '.idx')
+    if mb == 1:
+      t, _ = timeit(bytewise_h264, np.fromfile(name, dtype=np.uint8))
+      print '%6i MB: %8.3f s (%8.1f MB/s), byte-wise scan' % (mb, t, mb / t)
+  os.remove(name)
+
+def intPSNR(frame1, frame2, peak=255):
+  # Per-frame int64 PSNR, as done before the block engine
+  mse = ((frame1.astype(int) - frame2.astype(int))**2).sum() / frame1.size
+  return 20 * np.log10(peak / np.sqrt(mse)) if mse else 100
+
+def psnr(args):
+  '''psnr [frames]: PSNR engine throughput on QCIF, CIF, 720p and 1080p (default: 64 frames)'''
+  n = int(args[0]) if args else 64
+  rng = np.random.RandomState(0)
+  for name, (w, h) in [('QCIF', (176, 144)), ('CIF', (352, 288)), ('720p', (1280, 720)), ('1080p', (1920, 1080))]:
+    a = rng.randint(0, 256, size=(n, h, w)).astype(np.uint8)
+    b = rng.randint(0, 256, size=(n, h, w)).astype(np.uint8)
+    t, _ = timeit(lambda: [blockPSNR(a[i:i+16], b[i:i+16]) for i in xrange(0, n, 16)])
+    print '%6s: %8.1f fps' % (name, n / t),
+    t, _ = timeit(lambda: [intPSNR(a[i], b[i]) for i in xrange(n)])
+    print '(%8.1f fps per frame in int64)' % (n / t)
+
+def wangSSIM(frame1, frame2, peak=255):
+  # Float64 reference (ssim_index.m): 2-D Gaussian window, valid region
+  import cv2
+  g = cv2.getGaussianKernel(11, 1.5)
+  f = lambda a: cv2.filter2D(a, -1, g.dot(g.T))[5:-5, 5:-5]
+  C1, C2 = (0.01 * peak)**2, (0.03 * peak)**2
+  x, y = frame1.astype(np.float64), frame2.astype(np.float64)
+  mu1, mu2 = f(x), f(y)
+  s11, s22, s12 = f(x * x) - mu1**2, f(y * y) - mu2**2, f(x * y) - mu1 * mu2
+  return (((2 * mu1 * mu2 + C1) * (2 * s12 + C2)) / ((mu1**2 + mu2**2 + C1) * (s11 + s22 + C2))).mean()
+
+def wangMSSSIM(frame1, frame2, peak=255):
+  # Float64 reference (msssim.m): 2x2 averaging pyramid, luminance at the last scale only
+  import cv2
+  g = cv2.getGaussianKernel(11, 1.5)
+  C1, C2 = (0.01 * peak)**2, (0.03 * peak)**2
+  x, y = frame1.astype(np.float64), frame2.astype(np.float64)
+  weights = [0.0448, 0.2856, 0.3001, 0.2363, 0.1333]
+  value = 1
+  for i, weight in enumerate(weights):
+    b = 5 if min(x.shape) > 10 else 0
+    f = lambda a: cv2.filter2D(a, -1, g.dot(g.T))[b:a.shape[0]-b, b:a.shape[1]-b]
+    mu1, mu2 = f(x), f(y)
+    s11, s22, s12 = f(x * x) - mu1**2, f(y * y) - mu2**2, f(x * y) - mu1 * mu2
+    cs = (2 * s12 + C2) / (s11 + s22 + C2)
+    if i < len(weights) - 1:
+      value *= max(cs.mean(), 0)**weight
+      h, w = x.shape[0] / 2 * 2, x.shape[1] / 2 * 2
+      x, y = [(a[0:h:2, 0:w:2] + a[1:h:2, 0:w:2] + a[0:h:2, 1:w:2] + a[1:h:2, 1:w:2]) / 4 for a in (x, y)]
+    else:
+      value *= max(((2 * mu1 * mu2 + C1) / (mu1**2 + mu2**2 + C1) * cs).mean(), 0)**weight
+  return value
+
+def ssim(args):
+  '''ssim [frames]: SSIM, MS-SSIM and fast SSIM engine throughput and error on QCIF, CIF, 720p and 1080p (default: 32 frames)'''
+  n = int(args[0]) if args else 32
+  rng = np.random.RandomState(0)
+  for name, (w, h) in [('QCIF', (176, 144)), ('CIF', (352, 288)), ('720p', (1280, 720)), ('1080p', (1920, 1080))]:
+    a = rng.randint(0, 256, size=(n, h, w)).astype(np.uint8)
+    b = (a + rng.randint(-20, 21, size=(n, h, w))).clip(0, 255).astype(np.uint8)
+    t, values = timeit(lambda: [doSSIM(a[i], b[i]) for i in xrange(n)])
+    error = max(abs(values[i] - wangSSIM(a[i], b[i])) for i in xrange(min(n, 4)))
+    print '%6s: %8.1f fps, max error %.1e (SSIM);' % (name, n / t, error),
+    t, values = timeit(lambda: [doMSSSIM(a[i], b[i]) for i in xrange(n)])
+    error = max(abs(values[i] - wangMSSSIM(a[i], b[i])) for i in xrange(min(n, 4)))
+    print '%8.1f fps, max error %.1e (MS-SSIM);' % (n / t, error),
+    f = ssimScale(w, h)
+    t, _ = timeit(lambda: [doSSIM(a[i], b[i], 255, f) for i in xrange(n)])
+    print '%8.1f fps (SSIM downsampled by %i)' % (n / t, f)
+
+def backends(args):
+  '''backends [frames]: VQ engine (PSNR + SSIM) throughput per backend on CIF, 720p and 1080p (default: 64 frames)'''
+  n = int(args[0]) if args else 64
+  rng = np.random.RandomState(0)
+  pool = ProcessingPool(max(cpu_count(), 2))
+  for name, (w, h) in [('CIF', (352, 288)), ('720p', (1280, 720)), ('1080p', (1920, 1080))]:
+    files = []
+    for video in ['original', 'received']:
+      files.append(os.path.join(tempfile.gettempdir(), 'VTbench_%s.yuv' % video))
+      rng.randint(0, 256, size=n * w * h * 3 / 2).astype(np.uint8).tofile(files[-1])
+    rawdata = dict((video, YUVVideo(f, (w, h, 'I420'))) for video, f in zip(['original', 'received'], files))
+    results = []
+    for backend in ['serial', 'threads', 'processes']:
+      engine = VQengine({}, rawdata, backend=backend, pool=pool)
+      engine.require('psnr')
+      engine.require('ssim')
+      t, _ = timeit(engine.run)
+      results.append('%8.1f fps (%s)' % (n / t, backend))
+    print '%6s: %s [auto: %s]' % (name, ', '.join(results), VQengine({}, rawdata, pool=pool).chooseBackend())
+    for f in files:
+      os.remove(f)
+  pool.shutdown()
+
+def prefetch(args):
+  '''prefetch [frames]: CIF read speed and hit rate per prefetch size, and check that stopping early never hangs (default: 256 frames)'''
+  n = int(args[0]) if args else 256
+  name = os.path.join(tempfile.gettempdir(), 'VTbench_prefetch.yuv')
+  np.random.RandomState(0).randint(0, 256, size=n * 352 * 288 * 3 / 2).astype(np.uint8).tofile(name)
+  for size in [0, 1, 4]:
+    video = YUVVideo(name, (352, 288, 'I420'), prefetch=size)
+    t, _ = timeit(lambda: [frame['Y'].sum() for frame in video])
+    rate = ', hit rate %5.1f%%' % (100 * video.prefetcher.hitrate()) if size else ''
+    # Stopping early closes the prefetcher, which must not block whatever the queue size
+    def restart():
+      for i, frame in enumerate(video):
+        if i == 2:
+          break
+    hung = 0
+    for _ in xrange(40):
+      thread = threading.Thread(target=restart)
+      thread.daemon = True
+      thread.start()
+      thread.join(10)
+      hung += thread.is_alive()
+    print 'prefetch %i: %8.1f fps%s, %s' % (size, n / t, rate, 'HUNG %i of 40 times' % hung if hung else 'stops cleanly')
+  os.remove(name)
+
+def loopMIV(mos, refmos, interval=25):
+  # Nested loop over every window, as done before the cumulative sums
+  y = [0 for i in range(0, interval)]
+  for l in range(0, min(len(refmos), len(mos)) - interval):
+    i = 0
+    for j in range(l, l + interval):
+      if mos[j] < refmos[j] and mos[j] < 4:
+        i += 1
+    y.append(100 * float(i) / interval)
+  return y
+
+def miv(args):
+  '''miv [hours ...]: MIV speed and check against the nested loop on 25 fps sequences (default: 1 4)'''
+  hours = map(float, args) or [1, 4]
+  rng = np.random.RandomState(0)
+  for h in hours:
+    n = int(h * 3600 * 25)
+    refmos = rng.randint(3, 6, size=n).tolist()
+    mos = (np.array(refmos) - rng.binomial(2, 0.1, size=n)).tolist()
+    for interval in [25, 250]:
+      t, y = timeit(mivSeries, mos, refmos, interval)
+      t0, y0 = timeit(loopMIV, mos, refmos, interval)
+      print '%4.1f h, interval %3i: %8.3f s (%8.3f s with loops), %s' % (
+        h, interval, t, t0, 'identical' if y == y0 else 'DIFFERENT')
+
+def synthetic_rtp(n):
+  # ~1000 packets/s with 1% of bursty losses, microsecond arrival times and 90 kHz timestamps
+  rng = np.random.RandomState(0)
+  times = np.cumsum(rng.exponential(1e-3, size=n)).round(6)
+  sequences = np.cumsum(1 + (rng.rand(n) < 0.01) * rng.randint(1, 5, size=n))
+  timestamps = (times - rng.exponential(1e-3, size=n)).round(6) * 90000 // 1 / 90000
+  lengths = rng.randint(100, 1500, size=n)
+  return [a.tolist() for a in (lengths, times - times[0], sequences - sequences[0], timestamps - timestamps[0])]
+
+def loopQoS(lengths, times, sequences, timestamps):
+  # Per-packet loops over the lists, as done before the numpy measures
+  n = len(times)
+  delta, jitter, skew = [0] * n, [0] * n, [0] * n
+  for i in range(1, n):
+    delta[i] = (times[i] - times[i-1]) * 1000
+    d = ((times[i] - timestamps[i]) - (times[i-1] - timestamps[i-1])) * 1000
+    jitter[i] = jitter[i-1] + (abs(d) - jitter[i-1]) / 16
+    skew[i] = (timestamps[i] - times[i]) * 1000
+  x, l = map(list, zip(*sorted(zip(times, lengths))))
+  y = [0] * len(x)
+  for i in range(1, len(x)):
+    if x[i] == x[i-1]:
+      y[i] = -1
+  while -1 in y:
+    x.pop(y.index(-1))
+    y.pop(y.index(-1))
+    if -1 in y:
+      l.pop(y.index(-1))
+  for i in range(1, len(x)):
+    j = i
+    while x[j] + 1 > x[i] and j >= 0:
+      y[i] += l[j] * 8 / 1000
+      j -= 1
+  loss = sum(sequences[i] - sequences[i-1] - 1 for i in range(1, n))
+  pld, i, edge, count = [], 1, 1, 1
+  while i < n:
+    loss_i = 0
+    while i < n and times[i] < edge:
+      count, loss_i, i = count + 1, loss_i + sequences[i] - sequences[i-1] - 1, i + 1
+    pld.append(float(loss_i) / count)
+    count, edge = 0, edge + 1
+  return delta, jitter, skew, y, float(loss) / float(sequences[-1] + 1), pld
+
+def qos(args):
+  '''qos [packets ...]: QoS measures speed and check against the loops up to 1e5 packets (default: 1e4 1e5 1e6 1e7)'''
+  sizes = [int(float(a)) for a in args] or [10**4, 10**5, 10**6, 10**7]
+  measures = [Delta, Jitter, Skew, Bandwidth, PacketLossRate, PacketLossDist]
+  for n in sizes:
+    data = synthetic_rtp(n) + [[(0, 0)]]
+    results, times = [], []
+    for measure in measures:
+      t, res = timeit(measure(data).calculate)
+      results.append(res['axes'][1] if 'axes' in res else res['value'])
+      times.append('%s %.3f s' % (res['name'], t))
+    line = '%8i packets: %s' % (n, ', '.join(times))
+    if n <= 10**5:
+      t, loops = timeit(loopQoS, *data[:4])
+      line += ' (%.3f s with loops), %s' % (t, 'identical' if results == list(loops) else 'DIFFERENT')
+    print line
+
+benchmarks = {
+  'backends': backends,
+  'miv': miv,
+  'parsers': parsers,
+  'prefetch': prefetch,
+  'psnr': psnr,
+  'qos': qos,
+  'ssim': ssim
+}
+
+if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+  print 'Usage: ./benchmark.py <benchmark> [args]'
+  for name in sorted(benchmarks):
+    print '  ' + benchmarks[name].__doc__
+  sys.exit()
+
+benchmarks[sys.argv[1]](sys.argv[2:])
@@ -7,6 +7,7 @@
 # Description: convert .pkl files to .csv from <dir> (and all subdirs)
 
 import os, fnmatch, sys, pickle, csv
+from VideoTester.measures import heatmap
 
 if len(sys.argv) != 2:
     print 'Usage: pkl2csv.py <dir>'
@@ -58,7 +59,11 @@ for dir in dirs:
         if 'axes' in data:
             writer = csv.writer(f)
             writer.writerow(data['axes'][0])
-            if type(data['axes'][1]).__name__ == 'dict':
+            if data['type'] == 'heatmap':
+                # One row per macroblock row, averaged across the frame
+                for row in heatmap(data):
+                    writer.writerow(row)
+            elif type(data['axes'][1]).__name__ == 'dict':
                 writer.writerow(data['axes'][1]['I'])
                 writer.writerow(data['axes'][1]['P'])
                 writer.writerow(data['axes'][1]['B'])